@@ -0,0 +1,105 @@
+"""
+Measures the overhead of checkpointing a NUTS run with `modules.checkpoint`: wall time of
+the same run, warmup included, without checkpoints and with a checkpoint every 100, 500
+and 1000 draws, the part of it spent writing them and their size on disk. The same is
+measured for full-batch SVI, with the interval counted in steps.
+Run from the repository root: `python -m benchmarks.checkpoint`.
+"""
+import argparse
+import logging
+import os
+import tempfile
+import time
+import numpy as onp
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+MODELS = ('HierarchicalDrift', 'HierarchicalLLM', 'HierarchicalMeanReverting')
+
+
+def folder_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--model', default='HierarchicalMeanReverting', choices=MODELS)
+    parser.add_argument('--days', type=int, default=1000)
+    parser.add_argument('--items', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=300)
+    parser.add_argument('--samples', type=int, default=2000)
+    parser.add_argument('--steps', type=int, default=2000, help='number of SVI steps')
+    parser.add_argument('--intervals', type=int, nargs='+', default=[100, 500, 1000])
+    args = parser.parse_args()
+
+    from jax import jit, lax, random
+    import jax.numpy as np
+    from numpyro.contrib.autoguide import AutoContinuousELBO, AutoDiagonalNormal
+    from numpyro.infer import MCMC, NUTS, SVI
+    from numpyro.optim import Adam
+    import modules.checkpoint as checkpoint
+    import modules.numpyro_models as models
+    from modules.covariates import FactoredCovariates
+    from modules.optimisation import run_steps
+    from modules.precision import cast
+
+    # Time spent writing checkpoints
+    writes = {'time': 0.}
+
+    class TimedCheckpoint(checkpoint.Checkpoint):
+        def save_state(self, state, n):
+            start = time.perf_counter()
+            super(TimedCheckpoint, self).save_state(state, n)
+            writes['time'] += time.perf_counter() - start
+
+        def save_chunk(self, start, values):
+            begin = time.perf_counter()
+            super(TimedCheckpoint, self).save_chunk(start, values)
+            writes['time'] += time.perf_counter() - begin
+
+    rng = onp.random.RandomState(0)
+    X = FactoredCovariates(common=rng.rand(args.days, 12), individual=rng.rand(args.days, 1, args.items))
+    y = onp.log1p(rng.poisson(3, size=(args.days, args.items)))
+    inputs = cast({'X': X, 'y': y, 'brk': models.start_index(y)})
+    model = getattr(models, args.model)({'snap': 1, 'month': 12})
+
+    def sample(interval, path):
+        mcmc = MCMC(NUTS(model.model), num_warmup=args.warmup, num_samples=args.samples, progress_bar=False)
+        if interval is None:
+            mcmc.run(random.PRNGKey(0), **inputs)
+            return mcmc.get_samples()
+        run = TimedCheckpoint(path, checkpoint.run_key(model.model, inputs))
+        return checkpoint.run_mcmc(mcmc, random.PRNGKey(0), inputs, run, interval)[0]
+
+    def optimise(interval, path):
+        guide = AutoDiagonalNormal(model.model)
+        svi = SVI(model.model, guide, Adam(0.05), AutoContinuousELBO(), **inputs)
+        state = svi.init(random.PRNGKey(0))
+        scan = jit(lambda state, steps: lax.scan(lambda x, i: svi.update(x), state, steps))
+        if interval is None:
+            return scan(state, np.zeros(args.steps))[1]
+        run = TimedCheckpoint(path, checkpoint.run_key(model.model, inputs))
+        return run_steps(lambda state, start, size: scan(state, np.zeros(size)), state, args.steps, interval,
+                         checkpoint=run)[1]
+
+    for name, fit, unit in (('NUTS', sample, 'draws'), ('SVI', optimise, 'steps')):
+        baseline = None
+        for interval in [None] + args.intervals:
+            writes['time'] = 0.
+            with tempfile.TemporaryDirectory() as path:
+                start = time.perf_counter()
+                fit(interval, path)
+                elapsed = time.perf_counter() - start
+                size = folder_size(path)
+            if interval is None:
+                baseline = elapsed
+                logger.info('{} {}: {:.1f}s without checkpoints'.format(args.model, name, elapsed))
+                continue
+            logger.info('{} {}: {:.1f}s with a checkpoint every {} {}, overhead {:+.1%}, of which writing '
+                        '{:.2f}s, {:.1f}MB on disk'.format(args.model, name, elapsed, interval, unit,
+                                                         elapsed / baseline - 1, writes['time'], size / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
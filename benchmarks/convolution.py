@@ -0,0 +1,51 @@
+"""
+Times the batched `convolve` engine behind `expectation_convolution` and `hump`
+against the former per-column `numpy.convolve` loop.
+Run from the repository root: `python -m benchmarks.convolution`.
+"""
+import argparse
+import logging
+import time
+import numpy as onp
+from modules.transform import convolve
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+
+def loop_convolve(x, kernel):
+    return onp.concatenate([onp.convolve(x[:, i], kernel, mode='same').reshape(-1, 1)
+                            for i in range(x.shape[1])], axis=1)
+
+
+def timeit(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings), out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--days', type=int, default=1941)
+    parser.add_argument('--columns', type=int, nargs='+', default=[10, 1000, 30000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    kernels = {'expectation': onp.arange(15),
+               'hump': onp.square(onp.concatenate([onp.arange(0, 60), onp.arange(0, 59)[::-1]]))}
+    rng = onp.random.RandomState(0)
+    for n in args.columns:
+        x = (rng.rand(args.days, n) > 0.9).astype(onp.uint8)
+        for name, kernel in kernels.items():
+            loop, expected = timeit(lambda: loop_convolve(x, kernel), args.repeat)
+            for method in ('direct', 'fft', 'auto'):
+                batched, out = timeit(lambda: convolve(x, kernel, method), args.repeat)
+                assert onp.array_equal(out, expected)
+                logger.info('{} columns, {} kernel ({} taps), {}: loop={:.3f}s, batched={:.3f}s, x{:.1f}'.format(
+                    n, name, kernel.size, method, loop, batched, loop / batched))
+
+
+if __name__ == '__main__':
+    main()
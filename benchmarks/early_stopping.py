@@ -0,0 +1,55 @@
+"""
+Compares full-batch SVI run for a fixed number of steps with SVI stopped on a plateau of
+its loss (`modules.optimisation.Plateau`): number of steps, wall time and mean loss over
+the last steps of the run, where the step size of the early stopped run is lowest.
+Run from the repository root: `python -m benchmarks.early_stopping`.
+"""
+import argparse
+import logging
+import os
+import tempfile
+import time
+import numpy as onp
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+MODELS = ('HierarchicalDrift', 'HierarchicalLLM', 'HierarchicalMeanReverting')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--model', default='HierarchicalMeanReverting', choices=MODELS)
+    parser.add_argument('--days', type=int, default=300)
+    parser.add_argument('--items', type=int, default=5)
+    parser.add_argument('--steps', type=int, default=2000, help='maximum number of SVI steps')
+    parser.add_argument('--chunk-size', type=int, default=100)
+    parser.add_argument('--last', type=int, default=100, help='number of last steps the loss is averaged over')
+    args = parser.parse_args()
+
+    import modules.numpyro_models as models
+    from modules.covariates import FactoredCovariates
+    from modules.inference import run_inference
+
+    rng = onp.random.RandomState(0)
+    X = FactoredCovariates(common=rng.rand(args.days, 12), individual=rng.rand(args.days, 1, args.items))
+    y = onp.log1p(rng.poisson(3, size=(args.days, args.items)))
+    inputs = {'X': X, 'y': y, 'brk': models.start_index(y)}
+    model = getattr(models, args.model)({'snap': 1, 'month': 12})
+    # A first short run compiles what both runs share, such as the model.
+    run_inference(model.model, inputs, method='svi', num_steps=args.chunk_size, chunk_size=args.chunk_size)
+    with tempfile.TemporaryDirectory() as folder:
+        loss_file = os.path.join(folder, 'loss.csv')
+        for early_stopping in (False, True):
+            start = time.perf_counter()
+            run_inference(model.model, inputs, method='svi', num_steps=args.steps, chunk_size=args.chunk_size,
+                          early_stopping=early_stopping, loss_file=loss_file)
+            elapsed = time.perf_counter() - start
+            loss = onp.loadtxt(loss_file, delimiter=',', skiprows=1, ndmin=2)[:, 1]
+            logger.info('{} SVI {}: {} steps in {:.1f}s, mean loss over the last {} steps {:.1f}'.format(
+                args.model, 'with early stopping' if early_stopping else 'without early stopping',
+                len(loss), elapsed, args.last, float(onp.mean(loss[-args.last:]))))
+
+
+if __name__ == '__main__':
+    main()
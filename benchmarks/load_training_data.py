@@ -0,0 +1,44 @@
+"""
+Times `load_training_data` with and without the process-level memoization of
+`M5Data` frames. Run from the repository root: `python -m benchmarks.load_training_data`.
+"""
+import argparse
+import logging
+import time
+from modules.cache import memo
+from modules.utils import load_training_data
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+covariates = ['month', 'snap', 'christmas', 'event', 'trend', 'dayofweek', 'thanksgiving', 'price']
+
+
+def run(repeat, n_items, enabled):
+    memo.invalidate()
+    memo.reset_stats()
+    memo.enabled = enabled
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        load_training_data(items=range(n_items), covariates=covariates)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--items', type=int, default=200)
+    args = parser.parse_args()
+    # Build the on-disk caches once so that both settings read the same files.
+    load_training_data(items=range(args.items), covariates=covariates)
+    for enabled in (False, True):
+        timings = run(args.repeat, args.items, enabled)
+        logger.info('memo={}: first={:.3f}s, next={:.3f}s, {}'.format(
+            'on' if enabled else 'off', timings[0], min(timings[1:] or timings), memo.stats))
+    memo.enabled = True
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Compares NUTS under the float32 and float64 settings of `modules.precision`: time per
+sample and per leapfrog step, and peak memory. For the numerical agreement, the log
+density of the model is evaluated in both precisions at the float64 draws. Every
+precision runs in its own process, as the x64 mode of jax is fixed once arrays exist
+and the peak memory is per process.
+Run from the repository root: `python -m benchmarks.precision`.
+"""
+import argparse
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as onp
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+MODELS = ('HierarchicalDrift', 'HierarchicalLLM', 'HierarchicalMeanReverting')
+
+
+def run(args):
+    from modules.precision import cast, set_precision
+    set_precision(args.run)
+    from jax import random, vmap
+    from numpyro import handlers
+    from numpyro.infer import MCMC, NUTS
+    from numpyro.infer.util import log_density
+    import modules.numpyro_models as models
+    from modules.covariates import FactoredCovariates
+
+    rng = onp.random.RandomState(0)
+    X = FactoredCovariates(common=rng.rand(args.days, 12), individual=rng.rand(args.days, 1, args.items))
+    y = onp.log1p(rng.poisson(3, size=(args.days, args.items)))
+    inputs = cast({'X': X, 'y': y, 'brk': models.start_index(y)})
+    model = getattr(models, args.model)({'snap': 1, 'month': 12})
+    mcmc = MCMC(NUTS(model.model), num_warmup=args.warmup, num_samples=args.samples, progress_bar=False)
+    # Warmup, which includes the compilation, is timed apart from the sampling.
+    start = time.perf_counter()
+    mcmc.warmup(random.PRNGKey(0), **inputs)
+    warmup = time.perf_counter() - start
+    start = time.perf_counter()
+    mcmc.run(random.PRNGKey(1), **inputs, extra_fields=('num_steps',))
+    samples = {k: onp.asarray(v) for k, v in mcmc.get_samples().items()}
+    elapsed = time.perf_counter() - start
+    num_steps = int(onp.sum(mcmc.get_extra_fields()['num_steps']))
+    # ru_maxrss is in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    # Log density at the reference draws, or at the draws of this run
+    trace = handlers.trace(handlers.seed(model.model, random.PRNGKey(0))).get_trace(**inputs)
+    latent = [k for k, v in trace.items() if v['type'] == 'sample' and not v['is_observed']]
+    if args.reference is not None:
+        with onp.load(args.reference) as f:
+            points = {k: f[k] for k in latent}
+    else:
+        points = {k: samples[k] for k in latent}
+    points = cast({k: v[:args.points] for k, v in points.items()})
+    log_prob = vmap(lambda p: log_density(model.model, (), inputs, p)[0])(points)
+    onp.savez(args.out, warmup=warmup, elapsed=elapsed, num_steps=num_steps, peak=peak,
+              log_prob=onp.asarray(log_prob), **samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--model', default='HierarchicalMeanReverting', choices=MODELS)
+    parser.add_argument('--days', type=int, default=1000)
+    parser.add_argument('--items', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=300)
+    parser.add_argument('--samples', type=int, default=1000)
+    parser.add_argument('--points', type=int, default=100, help='draws where the log densities are compared')
+    parser.add_argument('--run', choices=('float32', 'float64'), help=argparse.SUPPRESS)
+    parser.add_argument('--out', help=argparse.SUPPRESS)
+    parser.add_argument('--reference', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run is not None:
+        return run(args)
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        reference = os.path.join(folder, 'float64.npz')
+        for precision in ('float64', 'float32'):
+            out = os.path.join(folder, '{}.npz'.format(precision))
+            command = [sys.executable, '-m', 'benchmarks.precision', '--run', precision, '--out', out,
+                       '--model', args.model, '--days', str(args.days), '--items', str(args.items),
+                       '--warmup', str(args.warmup), '--samples', str(args.samples), '--points', str(args.points)]
+            if precision == 'float32':
+                command += ['--reference', reference]
+            subprocess.run(command, check=True)
+            with onp.load(out) as f:
+                results[precision] = dict(f)
+            result = results[precision]
+            logger.info('{} {}: warmup {:.1f}s, {:.2f}ms per sample, {:.3f}ms per leapfrog step, '
+                        'peak memory {:.0f}MB'.format(args.model, precision, float(result['warmup']),
+                                                      1000 * float(result['elapsed']) / args.samples,
+                                                      1000 * float(result['elapsed']) / int(result['num_steps']),
+                                                      float(result['peak'])))
+    lp32, lp64 = results['float32']['log_prob'], results['float64']['log_prob']
+    error = onp.abs(lp32 - lp64) / onp.abs(lp64)
+    logger.info('Log density at {} float64 draws: max relative error of float32 {:.2e}, median {:.2e}'.format(
+        lp64.shape[0], float(error.max()), float(onp.median(error))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Times the gradient of the log density of the recursive models with the sequential
+(`lax.scan`) and associative (parallel prefix) evaluation of their recursions, or the
+vectorised evaluation of the observed recursion of `HierarchicalDrift`.
+Run from the repository root: `python -m benchmarks.scan --threads 4`.
+"""
+import argparse
+import logging
+import os
+import time
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--days', type=int, default=1913)
+    parser.add_argument('--items', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=os.cpu_count())
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    # XLA reads its flags when the backend starts, so they are set before importing jax.
+    os.environ['XLA_FLAGS'] = ' '.join([os.environ.get('XLA_FLAGS', ''),
+                                        '--xla_cpu_multi_thread_eigen=true',
+                                        'intra_op_parallelism_threads={}'.format(args.threads)])
+    import numpy as onp
+    from jax import device_put, grad, jit, random
+    from numpyro import handlers
+    from numpyro.infer.util import log_density
+    from modules.covariates import FactoredCovariates
+    from modules.numpyro_models import HierarchicalDrift, HierarchicalLLM, HierarchicalMeanReverting
+
+    rng = onp.random.RandomState(0)
+    X = FactoredCovariates(common=rng.rand(args.days, 12).astype(onp.float32),
+                           individual=rng.rand(args.days, 1, args.items).astype(onp.float32))
+    # On the device as in `main.load_input`: the sequential scans index the sales with the step.
+    y = device_put(onp.log1p(rng.poisson(3, size=(args.days, args.items))).astype(onp.float32))
+    X_dim = {'snap': 1, 'month': 12}
+    for Model in (HierarchicalDrift, HierarchicalLLM, HierarchicalMeanReverting):
+        for method in ('sequential', 'vectorised' if Model is HierarchicalDrift else 'associative'):
+            model = Model(X_dim, scan_method=method).model
+            trace = handlers.trace(handlers.seed(model, random.PRNGKey(0))).get_trace(X=X, y=y)
+            params = {k: v['value'] for k, v in trace.items() if v['type'] == 'sample' and not v['is_observed']}
+            grad_fn = jit(grad(lambda p: log_density(model, (), {'X': X, 'y': y}, p)[0]))
+            start = time.perf_counter()
+            grad_fn(params)['alpha'].block_until_ready()
+            compile_time = time.perf_counter() - start
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                grad_fn(params)['alpha'].block_until_ready()
+            logger.info('{} {}: compile={:.2f}s, gradient={:.2f}ms'.format(
+                Model.__name__, method, compile_time, 1000 * (time.perf_counter() - start) / args.repeat))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,24 @@
 import logging
+import os
 import jax.numpy as np
 import matplotlib.pyplot as plt
 import numpy as onp
 import numpyro
+# Before jax starts, so that the chains of NUTS can run in parallel
+numpyro.set_host_device_count(os.cpu_count())
 from numpyro.diagnostics import hpdi
 import pyro
 import torch
-from modules.transform import log_normalise, cluster, expectation_convolution, transform, hump
-from modules.numpyro_models import HierarchicalDrift, HierarchicalMeanReverting, HierarchicalLLM
+from modules.covariates import FactoredCovariates
+from modules.transform import log_normalise, cluster, expectation_convolution, hump
+from modules.pipeline import Pipeline, Stage, code_key
+from modules.precision import cast, set_precision
+from modules.numpyro_models import HierarchicalDrift, HierarchicalMeanReverting, HierarchicalLLM, start_index
 from modules.inference import run_inference, posterior_predictive, predict
 from modules.metrics import Metrics
 from modules.plots import plot_fit, plot_inference, plot_parameter_by_inference, plot_sales_and_covariate, plot_predict
-from modules.utils import load_training_data
+from modules.features import FeatureStore
+from modules.utils import load_training_data, M5Data
 from jax import lax, random, vmap
 from jax.nn import softmax
 from pyro.contrib.forecast import ForecastingModel, Forecaster, backtest, eval_crps, HMCForecaster
@@ -20,7 +27,6 @@ from pyro.infer.reparam import LocScaleReparam, StableReparam
 from pyro.ops.tensor_utils import periodic_cumsum, periodic_repeat, periodic_features
 from pyro.ops.stats import quantile
 
-numpyro.set_host_device_count(4)
 logger = logging.getLogger()
 logging.basicConfig(level=logging.INFO)
 
@@ -30,8 +36,14 @@ def jax_to_torch(x):
     return torch.from_numpy(data_)
 
 
-def load_input():
+def load_sources(items, covariates):
+    calendar, training_data = load_training_data(items=items, covariates=covariates)
+    return dict(training_data, calendar=calendar)
+
+
+def load_input(precision='float32'):
     assert numpyro.__version__.startswith('0.2.4')
+    set_precision(precision)  # 'float64' for numerical diagnostics
     logger.info('Main starting')
     steps = 2
     n_days = 15
@@ -40,29 +52,35 @@ def load_input():
     covariates = ['month', 'snap', 'christmas', 'event', 'trend', 'dayofweek',
                   'thanksgiving']  # List of considered covariates
     ind_covariates = ['snap']  # Item-specific covariates
-    common_covariates = set(covariates).difference(ind_covariates)  # List of non item-specific covariates
+    cat_covariates = ['dayofweek']  # Categorical covariates, passed as integer codes
+    common_covariates = sorted(set(covariates).difference(ind_covariates, cat_covariates))  # List of non item-specific covariates
     t_covariates = ['event', 'christmas']  # List of transformed covariates
     norm_covariates = []  # List of normalised covariates
     hump_covariates = ['month']  # List of convoluted covariates
     logger.info('Loading data')
-    calendar, training_data = load_training_data(items=items, covariates=covariates)
-    training_data = transform(expectation_convolution, training_data, t_covariates, steps, False)
-    training_data = transform(log_normalise, training_data, norm_covariates)
-    training_data = transform(hump, training_data, hump_covariates, n_days)
+    m5 = M5Data(r"data/")
+    pipeline = Pipeline([Stage(load_sources, None, items=items, covariates=covariates,
+                               key=[m5.signature(), code_key(load_training_data, FeatureStore)]),
+                         Stage(expectation_convolution, t_covariates, steps, False),
+                         Stage(log_normalise, norm_covariates),
+                         Stage(hump, hump_covariates, n_days)],
+                        path=os.path.join(m5.cache_path, "pipeline"))
+    training_data = pipeline.run()
+    calendar = training_data.pop('calendar')
     y = np.array(training_data[variable[0]])
     X_i = np.stack([training_data[x] for x in ind_covariates], axis=1)
     X_i_dim = dict(zip(ind_covariates, [1 for x in ind_covariates]))
-    X_c = np.repeat(np.hstack([training_data[i] for i in common_covariates])[..., np.newaxis],
-                    repeats=len(items),
-                    axis=2)
+    X_c = np.hstack([training_data[i] for i in common_covariates])
     X_c_dim = dict(zip(common_covariates, [training_data[x].shape[-1] for x in common_covariates]))
-    X = np.concatenate([X_i, X_c], axis=1)
+    X_cat = np.stack([np.argmax(training_data[x], axis=1) for x in cat_covariates], axis=1)
+    X_cat_dim = dict(zip(cat_covariates, [training_data[x].shape[-1] for x in cat_covariates]))
+    X = FactoredCovariates(common=X_c, individual=X_i, categorical=X_cat, categorical_dims=X_cat_dim.values())
     # Aggregation
-    y, X, clusters = cluster(y, X, 2)
-    X_dim = {**X_i_dim, **X_c_dim}
-    return {'X': X,
-            'X_dim': X_dim,
-            'y': np.log(1 + y)}, calendar
+    y, X, clusters = cluster(y, X, 2, cache=os.path.join(m5.cache_path, "clusters"))
+    X_dim = {**X_i_dim, **X_c_dim, **X_cat_dim}
+    return cast({'X': X,
+                 'X_dim': X_dim,
+                 'y': np.log(1 + y)}), calendar
 
 
 def main():
@@ -71,9 +89,11 @@ def main():
     T1 = 1000
     T2 = inputs['X'].shape[0]
     X_train, y_train, X_test, y_test = inputs['X'][:T1], inputs['y'][:T1], inputs['X'][T1:], inputs['y'][T1:]
-    inputs_train = {'X': X_train, 'y': y_train}
+    inputs_train = {'X': X_train, 'y': y_train, 'brk': start_index(y_train)}
     Model = HierarchicalDrift(X_dim=inputs['X_dim'])
-    samples = run_inference(model=Model.model, inputs=inputs_train)
+    # Rerunning after an interruption resumes the sampling from its last checkpoint.
+    samples = run_inference(model=Model.model, inputs=inputs_train,
+                            checkpoint=os.path.join(r"data/", "_cache", "checkpoints"))
     trace = posterior_predictive(Model.model, samples, inputs_train)
     # In sample forecast
     metric_data = {'trace': trace, 'actual': y_train, 'alpha': 0.95}
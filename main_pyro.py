@@ -1,16 +1,23 @@
 import logging
+import os
+import numpyro
+# Before jax starts, so that the chains of NUTS can run in parallel
+numpyro.set_host_device_count(os.cpu_count())
 logging.basicConfig(level=logging.INFO)
-from modules.transform import log_normalise,cluster,expectation_convolution,transform,hump
+from modules.covariates import FactoredCovariates
+from modules.transform import log_normalise, cluster, expectation_convolution, hump
+from modules.pipeline import Pipeline, Stage, code_key
+from modules.precision import cast, float_dtype, set_precision
 from modules.numpyro_models import HierarchicalDrift, HierarchicalMeanReverting, HierarchicalLLM
 from modules.inference import run_inference,posterior_predictive, predict
 from modules.metrics import Metrics
 from modules.plots import plot_fit,plot_inference,plot_parameter_by_inference,plot_sales_and_covariate,plot_predict
-from modules.utils import load_training_data
+from modules.features import FeatureStore
+from modules.utils import load_training_data, M5Data
 import jax.numpy as np
 from jax import lax, random, vmap
 from jax.nn import softmax
 import numpy as onp
-import numpyro
 from numpyro.diagnostics import hpdi
 import pyro
 import torch
@@ -20,15 +27,20 @@ from pyro.infer.reparam import LocScaleReparam, StableReparam
 from pyro.ops.tensor_utils import periodic_cumsum, periodic_repeat, periodic_features
 from pyro.ops.stats import quantile
 import matplotlib.pyplot as plt
-numpyro.set_host_device_count(8)
 logger = logging.getLogger()
 
 def jax_to_torch(x):
     data_ = onp.asarray(x)
     return torch.from_numpy(data_)
 
-def load_input():
+def load_sources(items, covariates):
+    calendar, training_data = load_training_data(items=items, covariates=covariates)
+    return dict(training_data, calendar=calendar)
+
+
+def load_input(precision='float32'):
     assert numpyro.__version__.startswith('0.2.4')
+    set_precision(precision)  # 'float64' for numerical diagnostics
     logger.info('Main starting')
     steps = 2
     n_days = 15
@@ -36,36 +48,44 @@ def load_input():
     variable = ['sales']  # Target variables
     covariates = ['month', 'snap', 'christmas', 'event', 'trend', 'dayofweek', 'thanksgiving']  # List of considered covariates
     ind_covariates = ['snap']  # Item-specific covariates
-    common_covariates = set(covariates).difference(ind_covariates)  # List of non item-specific covariates
+    cat_covariates = ['dayofweek']  # Categorical covariates, passed as integer codes
+    common_covariates = sorted(set(covariates).difference(ind_covariates, cat_covariates))  # List of non item-specific covariates
     t_covariates = ['event', 'christmas']  # List of transformed covariates
     norm_covariates = []  # List of normalised covariates
     hump_covariates = ['month']  # List of convoluted covariates
     logger.info('Loading data')
-    calendar, training_data = load_training_data(items=items, covariates=covariates)
-    training_data = transform(expectation_convolution, training_data, t_covariates, steps, False)
-    training_data = transform(log_normalise, training_data, norm_covariates)
-    training_data = transform(hump, training_data, hump_covariates, n_days)
+    m5 = M5Data(r"data/")
+    pipeline = Pipeline([Stage(load_sources, None, items=items, covariates=covariates,
+                               key=[m5.signature(), code_key(load_training_data, FeatureStore)]),
+                         Stage(expectation_convolution, t_covariates, steps, False),
+                         Stage(log_normalise, norm_covariates),
+                         Stage(hump, hump_covariates, n_days)],
+                        path=os.path.join(m5.cache_path, "pipeline"))
+    training_data = pipeline.run()
+    calendar = training_data.pop('calendar')
     y = np.array(training_data[variable[0]])
     X_i = np.stack([training_data[x] for x in ind_covariates], axis=1)
     X_i_dim = dict(zip(ind_covariates, [1 for x in ind_covariates]))
-    X_c = np.repeat(np.hstack([training_data[i] for i in common_covariates])[..., np.newaxis],
-                    repeats=len(items),
-                    axis=2)
+    X_c = np.hstack([training_data[i] for i in common_covariates])
     X_c_dim = dict(zip(common_covariates, [training_data[x].shape[-1] for x in common_covariates]))
-    X = np.concatenate([X_i,X_c], axis=1)
+    X_cat = np.stack([np.argmax(training_data[x], axis=1) for x in cat_covariates], axis=1)
+    X_cat_dim = dict(zip(cat_covariates, [training_data[x].shape[-1] for x in cat_covariates]))
+    X = FactoredCovariates(common=X_c, individual=X_i, categorical=X_cat, categorical_dims=X_cat_dim.values())
     # Aggregation
-    y,X,clusters = cluster(y,X,2)
-    X_dim = {**X_i_dim, **X_c_dim}
-    return {'X': X,
-            'X_dim': X_dim,
-            'y': np.log(1+y)}, calendar
+    y,X,clusters = cluster(y,X,2,cache=os.path.join(m5.cache_path, "clusters"))
+    X_dim = {**X_i_dim, **X_c_dim, **X_cat_dim}
+    return cast({'X': X,
+                 'X_dim': X_dim,
+                 'y': np.log(1 + y)}), calendar
 
 def main():
     inputs,calendar = load_input()
     logger.info('Inference')
     covariates, covariate_dim, data = inputs.values()
     data, covariates = map(jax_to_torch,[data,covariates])
-    data = torch.log(1+data.double())
+    # Pyro parameters follow the precision of the data
+    torch.set_default_dtype(torch.float64 if float_dtype() == onp.float64 else torch.float32)
+    data = torch.log(1 + data)
     assert pyro.__version__.startswith('1.3.1')
     pyro.enable_validation(True)
     T0 = 0  # begining
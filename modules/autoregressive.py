@@ -7,7 +7,7 @@ import jax.numpy as np
 from jax import lax, random, vmap
 from jax.nn import softmax
 import numpy as onp
-import numpyro; numpyro.set_host_device_count(4)
+import numpyro
 import numpyro.distributions as dist
 from numpyro.diagnostics import autocorrelation, hpdi
 from numpyro import handlers
@@ -0,0 +1,276 @@
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+
+def source_key(path):
+    """
+    Returns the `[size, mtime]` signature of a source file, used to detect when a
+    cached copy of it is stale.
+    :param str path: path of the source file.
+    """
+    stat = os.stat(path)
+    return [stat.st_size, int(stat.st_mtime)]
+
+
+class ColumnarCache:
+    """
+    A columnar on-disk store: every column is saved as its own `.npy` file and a
+    small `meta.json` index records the column names, the source signature and any
+    extra attributes. Columns are opened with `numpy.memmap`, so slicing rows or
+    days only touches the pages that are needed.
+
+    :param str path: folder holding the cache.
+    :param key: signature of the source data (see :func:`source_key`). A cache
+        written with a different key is considered stale.
+    """
+
+    meta_file = "meta.json"
+
+    def __init__(self, path, key=None):
+        self.path = path
+        self.key = key
+        self._meta = None
+        self._written = []
+
+    @property
+    def meta(self):
+        if self._meta is None:
+            with open(os.path.join(self.path, self.meta_file)) as f:
+                self._meta = json.load(f)
+        return self._meta
+
+    @property
+    def attrs(self):
+        return self.meta["attrs"]
+
+    @property
+    def columns(self):
+        return self.meta["columns"]
+
+    def is_valid(self):
+        """
+        Returns whether the cache exists and was built from the current source.
+        """
+        if not os.path.exists(os.path.join(self.path, self.meta_file)):
+            return False
+        return self.meta["key"] == self.key
+
+    def column_path(self, name):
+        return os.path.join(self.path, "{}.npy".format(name))
+
+    def load(self, name, mmap_mode="r"):
+        """
+        Returns the column `name`, memory-mapped in read-only mode by default.
+        :param str name: name of the column.
+        :param str mmap_mode: mode passed to `numpy.load`, `None` reads the column in memory.
+        """
+        return np.load(self.column_path(name), mmap_mode=mmap_mode, allow_pickle=False)
+
+    def begin(self):
+        """
+        Clears the cache before writing new columns to it.
+        """
+        self.invalidate()
+        os.makedirs(self.path)
+        self._written = []
+
+    def write(self, name, value):
+        """
+        Writes the column `name`. Must be called between :meth:`begin` and :meth:`commit`.
+        """
+        np.save(self.column_path(name), np.asarray(value), allow_pickle=False)
+        self._written.append(name)
+
+    def open_column(self, name, shape, dtype):
+        """
+        Creates the column `name` and returns it as a writable memmap, so that it can
+        be filled block by block without holding it in memory.
+        Must be called between :meth:`begin` and :meth:`commit`.
+        """
+        column = np.lib.format.open_memmap(self.column_path(name), mode="w+", dtype=dtype, shape=shape)
+        self._written.append(name)
+        return column
+
+    def commit(self, attrs=None):
+        """
+        Writes the metadata index. The index is written last so that an interrupted
+        write leaves an invalid cache rather than a corrupted one.
+        :param dict attrs: extra json-serializable attributes.
+        """
+        meta = {"key": self.key, "columns": self._written, "attrs": attrs or {}}
+        tmp_path = os.path.join(self.path, self.meta_file + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, os.path.join(self.path, self.meta_file))
+        self._meta = meta
+
+    def save(self, columns, attrs=None):
+        """
+        Writes all columns and the metadata index.
+        :param dict columns: mapping from column name to `np.ndarray`.
+        :param dict attrs: extra json-serializable attributes.
+        """
+        self.begin()
+        for name, value in columns.items():
+            self.write(name, value)
+        self.commit(attrs)
+
+    def invalidate(self):
+        """
+        Removes the cache from disk.
+        """
+        self._meta = None
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+
+
+def _label(label):
+    return label.item() if isinstance(label, np.generic) else label
+
+
+def _encode(values):
+    """
+    Returns a dict of `.npy`-friendly arrays encoding `values` and its kind.
+    Strings are dictionary-encoded as int32 codes (-1 for missing) plus categories.
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        categories = np.asarray(values.cat.categories).astype(str)
+        return {"codes": values.cat.codes.values.astype(np.int32), "categories": categories}, "category"
+    if np.issubdtype(values.dtype, np.datetime64):
+        return {"values": values.values.astype("datetime64[ns]")}, "datetime"
+    if values.dtype == object:
+        codes, categories = pd.factorize(values)
+        return {"codes": codes.astype(np.int32), "categories": np.asarray(categories).astype(str)}, "object"
+    return {"values": values.values}, "numeric"
+
+
+def _decode(cache, name, kind, mmap_mode="r"):
+    if kind in ("category", "object"):
+        codes = cache.load("{}.codes".format(name), mmap_mode=None)
+        categories = cache.load("{}.categories".format(name), mmap_mode=None)
+        values = pd.Categorical.from_codes(codes, categories)
+        return values if kind == "category" else np.asarray(values.astype(object))
+    return cache.load("{}.values".format(name), mmap_mode=mmap_mode)
+
+
+def write_frame(cache, df, block=None):
+    """
+    Writes the index and columns of a dataframe to a :class:`ColumnarCache` opened
+    with :meth:`ColumnarCache.begin`, and returns the attributes describing them.
+    :param ColumnarCache cache: target cache.
+    :param pd.DataFrame df: dataframe to write.
+    :param list block: labels of homogeneous numeric columns stored together as a
+        single row-major `num_rows x len(block)` matrix named `values`.
+    """
+    block = [] if block is None else list(block)
+    block_set = set(block)
+    kinds = {}
+    index, kinds["__index__"] = _encode(df.index.to_series())
+    for k, v in index.items():
+        cache.write("__index__.{}".format(k), v)
+    for name in df.columns:
+        if name in block_set:
+            continue
+        encoded, kinds[name] = _encode(df[name])
+        for k, v in encoded.items():
+            cache.write("{}.{}".format(name, k), v)
+    if block:
+        cache.write("values", np.ascontiguousarray(df[block].values))
+    return {"index_name": df.index.name,
+            "order": [_label(c) for c in df.columns],
+            "kinds": kinds,
+            "block": [_label(c) for c in block]}
+
+
+def dump_frame(cache, df, block=None, attrs=None):
+    """
+    Writes a dataframe to a :class:`ColumnarCache`.
+    :param ColumnarCache cache: target cache.
+    :param pd.DataFrame df: dataframe to write.
+    :param list block: labels of homogeneous numeric columns stored together as a
+        single row-major `num_rows x len(block)` matrix named `values`.
+    :param dict attrs: extra attributes stored in the index.
+    """
+    cache.begin()
+    frame_attrs = write_frame(cache, df, block)
+    frame_attrs.update(attrs or {})
+    cache.commit(frame_attrs)
+
+
+def load_column(cache, name, mmap_mode="r"):
+    """
+    Returns a single column of a dataframe stored by :func:`dump_frame`.
+    """
+    return _decode(cache, name, cache.attrs["kinds"][name], mmap_mode=mmap_mode)
+
+
+def load_frame(cache):
+    """
+    Rebuilds the dataframe stored by :func:`dump_frame`.
+    """
+    attrs = cache.attrs
+    kinds = attrs["kinds"]
+    index = pd.Index(_decode(cache, "__index__", kinds["__index__"]), name=attrs["index_name"])
+    data = {name: _decode(cache, name, kind) for name, kind in kinds.items() if name != "__index__"}
+    frames = [pd.DataFrame(data, index=index)]
+    if attrs["block"]:
+        frames.append(pd.DataFrame(np.asarray(cache.load("values")), index=index, columns=attrs["block"]))
+    df = pd.concat(frames, axis=1) if len(frames) > 1 else frames[0]
+    return df[attrs["order"]]
+
+
+class Memo:
+    """
+    Process-level memoization of values read from disk caches. Entries are keyed on
+    the cache path and its source signature, so a rebuilt cache is never served
+    stale, and `loads` / `hits` count disk reads against memoized accesses.
+
+    Memoized values are shared across callers and must not be modified in place.
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self.loads = 0
+        self.hits = 0
+        self._store = {}
+
+    def get(self, cache, name, load_fn):
+        """
+        Returns the value `name` of `cache`, calling `load_fn` only on the first access.
+        :param ColumnarCache cache: cache the value is read from.
+        :param str name: name of the value within the cache.
+        :param callable load_fn: function reading the value from disk.
+        """
+        key = (cache.path, json.dumps(cache.key), name)
+        if self.enabled and key in self._store:
+            self.hits += 1
+            return self._store[key]
+        self.loads += 1
+        value = load_fn()
+        if self.enabled:
+            self._store[key] = value
+        return value
+
+    def invalidate(self, path=None):
+        """
+        Drops memoized values, only those of caches stored under `path` if given.
+        """
+        if path is None:
+            self._store.clear()
+        else:
+            path = os.path.abspath(path)
+            self._store = {k: v for k, v in self._store.items()
+                           if not os.path.abspath(k[0]).startswith(path)}
+
+    def reset_stats(self):
+        self.loads, self.hits = 0, 0
+
+    @property
+    def stats(self):
+        return {"loads": self.loads, "hits": self.hits, "entries": len(self._store)}
+
+
+memo = Memo()
@@ -0,0 +1,211 @@
+import inspect
+import logging
+import os
+import re
+import shutil
+import sys
+import jax.numpy as np
+import numpy as onp
+from jax import random
+from jax.tree_util import tree_flatten, tree_leaves, tree_unflatten
+from modules.cache import ColumnarCache
+from modules.features import digest
+from modules.pipeline import code_key
+
+logger = logging.getLogger()
+
+
+def model_config(model):
+    """
+    Returns the configuration of the :class:`modules.numpyro_models.Model` of a model method,
+    or None for a plain function, with the order of the keys of its dicts: the columns of the
+    covariates follow the order of `X_dim`, which a json dump with sorted keys would lose.
+    """
+    if not inspect.ismethod(model):
+        return None
+    config = vars(model.__self__)
+    return [config, {name: list(value) for name, value in config.items() if isinstance(value, dict)}]
+
+
+def code_modules(model):
+    """
+    Returns the modules whose code a model runs: those defining the model, and its class and
+    base classes for a method, with the modules of the same package they import, directly
+    or not, e.g. `modules.scan` and `modules.kalman` for `modules.numpyro_models`.
+    """
+    roots = [model.__module__]
+    if inspect.ismethod(model):
+        roots += [cls.__module__ for cls in type(model.__self__).__mro__ if cls is not object]
+    packages = {name.split('.')[0] for name in roots}
+    found, todo = {}, list(roots)
+    while todo:
+        name = todo.pop()
+        module = sys.modules.get(name)
+        if name in found or module is None:
+            continue
+        found[name] = module
+        for value in vars(module).values():
+            dependency = value.__name__ if inspect.ismodule(value) else getattr(value, '__module__', None)
+            if isinstance(dependency, str) and dependency.split('.')[0] in packages:
+                todo.append(dependency)
+    return [found[name] for name in sorted(found)]
+
+
+def model_key(model):
+    """
+    Returns the key of the code and the configuration of a model: it changes with the source of
+    the modules returned by :func:`code_modules` and with :func:`model_config`.
+    :param model: numpyro model, e.g. the `model` method of a :class:`modules.numpyro_models.Model`.
+    """
+    return digest(model.__module__, model.__qualname__, code_key(*code_modules(model)), model_config(model))
+
+
+def run_key(model, inputs, **config):
+    """
+    Returns the key of an inference run: a checkpoint is only resumed by a run of the same
+    model code and configuration (see :func:`model_key`), on the same data and with the
+    same settings.
+    :param model: numpyro model, e.g. the `model` method of a :class:`modules.numpyro_models.Model`.
+    :param dict inputs: keyword arguments of the model.
+    :param config: json-serializable settings of the run, e.g. the number of samples.
+    """
+    names = sorted(inputs)
+    return digest(model_key(model), names, config,
+                  *tree_leaves([inputs[name] for name in names]))
+
+
+class Checkpoint(object):
+    """
+    Checkpoints of a long inference run, in a folder. The state of the run, a pytree such
+    as the `HMCState` of the chains or the `SVIState` of the optimizer with its random key,
+    is saved leaf by leaf in `state-{n}`, where `n` is the number of draws or steps done.
+    What the run collects, draws or losses, is saved by chunk in `chunk-{start}`. Both are
+    :class:`modules.cache.ColumnarCache` folders of `.npy` files; a new state is committed
+    before the previous one is removed, so an interruption at any point leaves a valid one.
+
+    :param str path: folder of the checkpoints.
+    :param str key: key of the run, see :func:`run_key`. Checkpoints of another key are ignored.
+    """
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+
+    def _caches(self, prefix):
+        # Valid caches named `{prefix}-{n}`, by increasing n.
+        if not os.path.isdir(self.path):
+            return []
+        caches = []
+        for name in os.listdir(self.path):
+            match = re.match(r'{}-(\d+)$'.format(prefix), name)
+            if match is not None:
+                cache = ColumnarCache(os.path.join(self.path, name), key=self.key)
+                if cache.is_valid():
+                    caches.append((int(match.group(1)), cache))
+        return sorted(caches, key=lambda x: x[0])
+
+    def load_state(self, template):
+        """
+        Returns the last saved state and its count as `(state, n)`, or None if there is none.
+        :param callable template: returns a state of the same structure, only called when
+            a state is found.
+        """
+        caches = self._caches('state')
+        if not caches:
+            return None
+        n, cache = caches[-1]
+        tree = tree_flatten(template())[1]
+        leaves = [np.asarray(cache.load(name, mmap_mode=None)) for name in cache.columns]
+        return tree_unflatten(tree, leaves), n
+
+    def save_state(self, state, n):
+        """
+        Saves `state` after `n` draws or steps, and removes the previous states.
+        """
+        cache = ColumnarCache(os.path.join(self.path, 'state-{:08d}'.format(n)), key=self.key)
+        cache.save({'leaf_{:04d}'.format(i): onp.asarray(leaf) for i, leaf in enumerate(tree_leaves(state))})
+        for m, previous in self._caches('state'):
+            if m != n:
+                previous.invalidate()
+
+    def save_chunk(self, start, values):
+        """
+        Saves the values collected from draw or step `start` on.
+        :param int start: index of the first draw or step of the chunk.
+        :param dict values: mapping from name to array.
+        """
+        ColumnarCache(os.path.join(self.path, 'chunk-{:08d}'.format(start)), key=self.key).save(
+            {name: onp.asarray(value) for name, value in values.items()})
+
+    def iter_chunks(self, end):
+        """
+        Yields the chunks collected before draw or step `end` in order, as `(start, values)`.
+        """
+        for start, cache in self._caches('chunk'):
+            if start < end:
+                yield start, {name: cache.load(name, mmap_mode=None) for name in cache.columns}
+
+    def load_chunks(self, end, axis=0):
+        """
+        Returns the values collected before draw or step `end`, concatenated along `axis`.
+        """
+        chunks = [values for _, values in self.iter_chunks(end)]
+        if not chunks:
+            return {}
+        return {name: onp.concatenate([values[name] for values in chunks], axis=axis) for name in chunks[0]}
+
+    def clear(self):
+        """
+        Removes all checkpoints from disk.
+        """
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+
+
+def run_mcmc(mcmc, rng_key, inputs, checkpoint, interval, extra_fields=(), init_params=None):
+    """
+    Runs `mcmc` by chunks of `interval` draws per chain, saving the state of the chains and
+    the new draws after every chunk. A run interrupted after its warmup resumes from its last
+    checkpoint, with the random keys of the chains, and gives the same draws as if it had not
+    been interrupted; an interruption during the warmup restarts it.
+    :param mcmc: `numpyro.infer.MCMC` of a kernel of the HMC family.
+    :param rng_key: random number generator seed of the warmup.
+    :param dict inputs: keyword arguments of the model.
+    :param Checkpoint checkpoint: checkpoints of the run.
+    :param int interval: number of draws per chain between checkpoints.
+    :param tuple extra_fields: fields of the `HMCState` collected with the draws.
+    :param init_params: initial unconstrained parameters of the warmup.
+    :return: the draws and the extra fields, grouped by chain, and the last state.
+    """
+    num_samples = mcmc.num_samples
+
+    def template():
+        # The kernel is set up on the inputs as by the warmup, which also gives the structure
+        # of the state: it is the same for one chain or for a batch of them.
+        init_key = random.split(rng_key, mcmc.num_chains) if mcmc.chain_method == 'vectorized' else rng_key
+        return mcmc.sampler.init(init_key, mcmc.num_warmup, init_params, model_args=(), model_kwargs=inputs)
+
+    restored = checkpoint.load_state(template)
+    if restored is None:
+        checkpoint.clear()
+        mcmc.warmup(rng_key, **inputs, init_params=init_params)
+        state, start = mcmc._warmup_state, 0
+        checkpoint.save_state(state, start)
+    else:
+        state, start = restored
+        logger.info('Resuming from draw {} of {} per chain'.format(start, num_samples))
+    while start < num_samples:
+        mcmc.num_samples = min(interval, num_samples - start)
+        # The chains continue from the saved state with their own random keys.
+        mcmc._warmup_state = state
+        mcmc.run(state.rng_key, **inputs, extra_fields=extra_fields)
+        checkpoint.save_chunk(start, {**{'z_{}'.format(k): v for k, v in mcmc.get_samples(group_by_chain=True).items()},
+                                      **mcmc.get_extra_fields(group_by_chain=True)})
+        state, start = mcmc._last_state, start + mcmc.num_samples
+        checkpoint.save_state(state, start)
+        logger.info('Checkpoint at draw {} of {} per chain'.format(start, num_samples))
+    mcmc.num_samples = num_samples
+    values = checkpoint.load_chunks(num_samples, axis=1)
+    samples = {k[2:]: v for k, v in values.items() if k.startswith('z_')}
+    return samples, {k: v for k, v in values.items() if not k.startswith('z_')}, state
+
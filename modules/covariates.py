@@ -0,0 +1,111 @@
+import jax.numpy as np
+import numpy as onp
+from jax.tree_util import register_pytree_node
+
+
+class FactoredCovariates(object):
+    """
+    Covariates split into common covariates, shared by all items, with shape
+    `T x n_common`, item-specific covariates with shape `T x n_individual x n_items`
+    and categorical covariates given as integer codes with shape `T x n_categorical`.
+    It stands for the dense `T x n_cov x n_items` tensor (item-specific covariates first,
+    then common ones, then the one-hot encoding of each categorical covariate) without
+    ever materializing copies of the common covariates or the one-hot blocks.
+
+    :param common: common covariates with shape `T x n_common`.
+    :param individual: item-specific covariates with shape `T x n_individual x n_items`.
+    :param categorical: codes of the categorical covariates with shape `T x n_categorical`.
+    :param tuple categorical_dims: number of categories of each categorical covariate.
+    """
+
+    def __init__(self, common, individual, categorical=None, categorical_dims=()):
+        self.common = common
+        self.individual = individual
+        if categorical is None:
+            categorical = np.zeros((common.shape[0], 0), dtype=np.int32)
+        self.categorical = categorical
+        self.categorical_dims = tuple(categorical_dims)
+
+    @property
+    def shape(self):
+        l, n_individual, n_items = self.individual.shape
+        return l, n_individual + self.common.shape[-1] + sum(self.categorical_dims), n_items
+
+    @property
+    def n_individual(self):
+        return self.individual.shape[1]
+
+    @property
+    def n_dense(self):
+        return self.individual.shape[1] + self.common.shape[1]
+
+    def __getitem__(self, key):
+        """
+        Slices the time dimension, e.g. `X[:T1]`.
+        """
+        return FactoredCovariates(self.common[key], self.individual[key], self.categorical[key],
+                                  self.categorical_dims)
+
+    def take(self, items):
+        """
+        Selects a subset of items, e.g. a minibatch; common and categorical covariates are shared.
+        :param items: indices of the items.
+        """
+        return FactoredCovariates(self.common, self.individual[:, :, items], self.categorical,
+                                  self.categorical_dims)
+
+    def effect(self, beta):
+        """
+        Returns the covariate effect `sum_k X[t, k, i] * beta[k, i]` with shape `T x n_items`,
+        computed as one shared matmul for the common covariates, a per-item term for the
+        item-specific covariates and a gather `beta[code]` for the categorical covariates.
+        :param beta: coefficients with shape `n_cov x n_items`.
+        """
+        n, n_dense = self.n_individual, self.n_dense
+        mu = (np.matmul(self.common, beta[n:n_dense])
+              + np.sum(self.individual * beta[np.newaxis, :n], axis=1))
+        if self.categorical_dims:
+            offsets = n_dense + onp.cumsum((0,) + self.categorical_dims[:-1])
+            mu += np.sum(beta[self.categorical + offsets], axis=1)
+        return mu
+
+    def dense(self):
+        """
+        Returns the dense `T x n_cov x n_items` tensor.
+        """
+        l, _, n_items = self.individual.shape
+        one_hot = [self.categorical[:, i, np.newaxis] == np.arange(dim)
+                   for i, dim in enumerate(self.categorical_dims)]
+        common = np.concatenate([self.common] + [x.astype(self.common.dtype) for x in one_hot], axis=1)
+        common = np.repeat(common[..., np.newaxis], repeats=n_items, axis=2)
+        return np.concatenate([self.individual, common], axis=1)
+
+    def __array__(self, dtype=None):
+        return onp.asarray(self.dense(), dtype=dtype)
+
+
+register_pytree_node(FactoredCovariates,
+                     lambda x: ((x.common, x.individual, x.categorical), x.categorical_dims),
+                     lambda dims, children: FactoredCovariates(*children, categorical_dims=dims))
+
+
+def covariate_effect(X, beta):
+    """
+    Returns the covariate effect with shape `T x n_items` of dense or factored covariates.
+    :param X: `T x n_cov x n_items` array or :class:`FactoredCovariates`.
+    :param beta: coefficients with shape `n_cov x n_items`.
+    """
+    if isinstance(X, FactoredCovariates):
+        return X.effect(beta)
+    return np.matmul(X.transpose((-1, -3, -2)), beta.T[..., None]).sum(-1).T
+
+
+def take_items(X, items):
+    """
+    Selects a subset of items of dense or factored covariates.
+    :param X: `T x n_cov x n_items` array or :class:`FactoredCovariates`.
+    :param items: indices of the items.
+    """
+    if isinstance(X, FactoredCovariates):
+        return X.take(items)
+    return X[..., items]
@@ -0,0 +1,57 @@
+import hashlib
+import json
+import os
+import numpy as np
+from modules.cache import memo
+
+
+def digest(*values):
+    """
+    Returns a short hash of arrays and json-serializable values, used to key cached
+    features on their inputs and parameters.
+    """
+    h = hashlib.sha1()
+    for value in values:
+        if isinstance(value, np.ndarray) or hasattr(value, "__array__"):
+            x = np.ascontiguousarray(value)
+            h.update("{}{}".format(x.dtype, x.shape).encode())
+            h.update(x.tobytes())
+        else:
+            h.update(json.dumps(value, sort_keys=True, default=str).encode())
+    return h.hexdigest()[:16]
+
+
+class FeatureStore:
+    """
+    Lazily computed, cached covariates. Each calendar feature is computed once per
+    name and parameters, persisted as a compact array (uint8 for one-hots and flags)
+    in a :class:`modules.cache.ColumnarCache` keyed on the calendar source, and
+    memory-mapped on demand.
+
+    :param M5Data m5: data helper the calendar features are computed from.
+    """
+    features = {
+        'christmas': ('get_christmas', np.uint8),
+        'thanksgiving': ('get_thanksgiving', np.uint8),
+        'dayofweek': ('get_dummy_day_of_week', np.uint8),
+        'dayofmonth': ('get_dummy_day_of_month', np.uint8),
+        'month': ('get_dummy_month_of_year', np.uint8),
+        'snap': ('get_snap', np.uint8),
+        'event': ('get_event', np.uint8),
+        'trend': ('get_trend', np.float32),
+    }
+
+    def __init__(self, m5):
+        self.m5 = m5
+
+    def get(self, name, **params):
+        """
+        Returns the calendar feature ``name`` with shape `num_days x dim`.
+        :param str name: one of `FeatureStore.features`.
+        :param params: keyword arguments of the corresponding `M5Data` getter.
+        """
+        getter, dtype = self.features[name]
+        cache = self.m5._cache(os.path.join("features", "{}-{}".format(name, digest(params))), "calendar.csv")
+        if not cache.is_valid():
+            cache.save({"values": np.asarray(getattr(self.m5, getter)(**params)).astype(dtype)})
+        return memo.get(cache, "values", lambda: cache.load("values"))
@@ -1,16 +1,21 @@
 import logging
+import math
+import os
+import time
+import jax
 import jax.numpy as np
-from jax import lax, random, vmap
+from jax import jit, lax, random, vmap
 from jax.nn import softmax
 import numpy as onp
 import numpyro
 from functools import partial
+from itertools import islice
 import numpyro.distributions as dist
-from numpyro.diagnostics import autocorrelation, hpdi
+from numpyro.diagnostics import autocorrelation, effective_sample_size, hpdi
 from numpyro import handlers
 from numpyro.util import fori_loop
 from numpyro.infer.util import init_to_prior, init_to_median
-from numpyro.infer import MCMC, NUTS, SVI, SA
+from numpyro.infer import ELBO, MCMC, NUTS, SVI, SA
 from numpyro.contrib.autoguide import (AutoContinuousELBO,
                                        AutoLaplaceApproximation,
                                        AutoDiagonalNormal,
@@ -19,50 +24,196 @@ from numpyro.contrib.autoguide import (AutoContinuousELBO,
                                        AutoLowRankMultivariateNormal)
 from numpyro.optim import Adam
 from numpyro.infer import Predictive
+from modules.checkpoint import Checkpoint, run_key, run_mcmc
+from modules.numpyro_models import Model
+from modules.optimisation import Plateau, run_steps, scheduled_update
+from modules.precision import cast
+from modules.subsample import AutoItemNormal, batch_rows_update, item_batches, without_items
+from modules.warmstart import WarmNUTS, adaptation_key, load_adaptation, save_adaptation
 
 logger = logging.getLogger()
 
+MAX_CHAINS = 4
 
-def run_inference(model, inputs, method=None):
+
+def chain_defaults(num_chains=None, chain_method=None):
+    """
+    Returns the number of MCMC chains and how to run them. By default there is one chain
+    per CPU core, up to `MAX_CHAINS`, run in parallel over the host devices when there are
+    enough of them (see `numpyro.set_host_device_count`) and in sequence otherwise.
+    :param int num_chains: number of chains, from the CPU count if None.
+    :param str chain_method: 'parallel', 'vectorized' or 'sequential', from the device count if None.
+    """
+    if num_chains is None:
+        num_chains = max(1, min(os.cpu_count() or 1, MAX_CHAINS))
+    if chain_method is None:
+        chain_method = 'parallel' if jax.local_device_count() >= num_chains else 'sequential'
+    if chain_method == 'parallel' and jax.local_device_count() < num_chains:
+        logger.warning('{} chains on {} devices: call numpyro.set_host_device_count({}) before jax starts '
+                       'to run them in parallel'.format(num_chains, jax.local_device_count(), num_chains))
+        chain_method = 'sequential'
+    return num_chains, chain_method
+
+
+def run_inference(model, inputs, method=None, batch_size=None, num_steps=2000, num_samples=5000,
+                  num_chains=None, chain_method=None, group_by_chain=False, num_warmup=300,
+                  warm_start=None, warm_num_warmup=50, checkpoint=None, checkpoint_interval=500,
+                  chunk_size=100, early_stopping=True, loss_file=None):
+    """
+    Fits the model with NUTS (`method=None`) or SVI.
+    :param model: numpyro model.
+    :param dict inputs: keyword arguments of the model.
+    :param method: None for NUTS, otherwise SVI.
+    :param int batch_size: with SVI, number of items drawn at every step; all items if None. A step
+        only updates the per-item parameters of its items, see :func:`modules.subsample.batch_rows_update`.
+    :param int num_steps: maximum number of SVI steps.
+    :param int num_samples: total number of NUTS draws, split across the chains.
+    :param int num_chains: number of NUTS chains, see :func:`chain_defaults`.
+    :param str chain_method: how the NUTS chains are run, see :func:`chain_defaults`.
+    :param bool group_by_chain: return NUTS samples with a leading `num_chains` dimension.
+    :param int num_warmup: number of NUTS warmup steps.
+    :param str warm_start: folder where the NUTS adaptation is saved after every run. When it
+        holds a valid adaptation for the model (see :func:`modules.warmstart.adaptation_key`),
+        NUTS starts from it with `warm_num_warmup` warmup steps instead of `num_warmup`.
+    :param int warm_num_warmup: number of warmup steps of a warm start, which may be 0.
+    :param str checkpoint: folder where the run is checkpointed every `checkpoint_interval` NUTS
+        draws per chain, or after every chunk of SVI steps, see :class:`modules.checkpoint.Checkpoint`.
+        Calling the function again with the same model, inputs and settings resumes the run from
+        its last checkpoint, or reloads its result when it had finished.
+    :param int checkpoint_interval: number of NUTS draws per chain between checkpoints.
+    :param int chunk_size: number of SVI steps compiled together, between which the convergence
+        is checked and the losses are logged.
+    :param bool early_stopping: stop SVI when its loss reaches a plateau, after lowering the step
+        size, see :class:`modules.optimisation.Plateau`; otherwise run `num_steps` steps.
+    :param str loss_file: csv file where the SVI losses are written as the optimisation goes.
+    :return: dict of posterior samples, in the precision of :func:`modules.precision.set_precision`.
+    """
+    if batch_size is None:
+        inputs = cast(inputs)
+    if checkpoint is not None:
+        checkpoint = os.path.join(checkpoint, model.__qualname__)
     if method is None:
         # NUTS
-        num_samples = 5000
-        logger.info('NUTS sampling')
-        kernel = NUTS(model)
-        mcmc = MCMC(kernel, num_warmup=300, num_samples=num_samples)
+        num_chains, chain_method = chain_defaults(num_chains, chain_method)
+        logger.info('NUTS sampling with {} chains ({})'.format(num_chains, chain_method))
+        adaptation = None
+        if warm_start is not None:
+            warm_start = os.path.join(warm_start, model.__qualname__)
+            key = adaptation_key(model, inputs, num_chains)
+            adaptation = load_adaptation(warm_start, key)
+            if adaptation is None:
+                logger.info('No adaptation for this model and data shape, full warmup')
+        if adaptation is None:
+            kernel, init_params = NUTS(model), None
+        else:
+            logger.info('Warm start with {} warmup steps'.format(warm_num_warmup))
+            init_params, step_size, inverse_mass_matrix = cast(adaptation)
+            kernel, num_warmup = WarmNUTS(model, step_size, inverse_mass_matrix), warm_num_warmup
+        num_samples = int(math.ceil(num_samples / num_chains))
+        mcmc = MCMC(kernel, num_warmup=num_warmup, num_samples=num_samples,
+                    num_chains=num_chains, chain_method=chain_method)
         rng_key = random.PRNGKey(0)
-        mcmc.run(rng_key, **inputs, extra_fields=('potential_energy',))
+        start = time.perf_counter()
+        if checkpoint is None:
+            mcmc.run(rng_key, **inputs, extra_fields=('potential_energy',), init_params=init_params)
+            samples, last_state = mcmc.get_samples(group_by_chain=True), mcmc._last_state
+        else:
+            checkpoints = Checkpoint(checkpoint, run_key(model, inputs, method='NUTS', num_warmup=num_warmup,
+                                                         num_samples=num_samples, num_chains=num_chains))
+            samples, extra_fields, last_state = run_mcmc(mcmc, rng_key, inputs, checkpoints, checkpoint_interval,
+                                                         extra_fields=('potential_energy',), init_params=init_params)
+        elapsed = time.perf_counter() - start
+        if warm_start is not None:
+            save_adaptation(warm_start, key, last_state)
         logger.info(r'MCMC summary for: {}'.format(model.__name__))
-        mcmc.print_summary(exclude_deterministic=False)
-        samples = mcmc.get_samples()
+        if checkpoint is None:
+            mcmc.print_summary(exclude_deterministic=False)
+        else:
+            numpyro.diagnostics.print_summary(samples, prob=0.90, group_by_chain=True)
+            logger.info('Number of divergences: {}'.format(int(onp.sum(extra_fields['diverging']))))
+        # Constant (deterministic) sites have an undefined ESS and are ignored.
+        ess = float(onp.nanmin(onp.concatenate([onp.ravel(effective_sample_size(onp.asarray(v)))
+                                                for v in samples.values() if onp.issubdtype(v.dtype, onp.floating)])))
+        logger.info('Sampling took {:.1f}s, {:.2f}ms per effective sample (min ESS={:.0f})'.format(
+            elapsed, 1000 * elapsed / ess, ess))
+        if not group_by_chain:
+            samples = {k: np.reshape(v, (-1,) + np.shape(v)[2:]) for k, v in samples.items()}
+    elif batch_size is not None:
+        # SVI on minibatches of items
+        logger.info('Minibatch SVI over {} items per step'.format(batch_size))
+        guide = AutoItemNormal(model=model)
+        plateau = Plateau(step_size=0.05)
+        svi = SVI(without_items(model), guide, Adam(plateau.step_size), ELBO())
+        state = svi.init(random.PRNGKey(0), **cast(next(item_batches(inputs, batch_size))))
+        update = jit(batch_rows_update(scheduled_update(svi, Adam), guide))
+
+        def steps(state, start, size):
+            # Batches are cast one by one, rather than the whole data up front.
+            losses = []
+            for batch in map(cast, islice(item_batches(inputs, batch_size, start=start), size)):
+                state, loss = update(state, plateau.step_size, **batch)
+                losses.append(loss)
+            return state, np.stack(losses)
+
+        checkpoints = None
+        if checkpoint is not None:
+            checkpoints = Checkpoint(checkpoint, run_key(model, inputs, method='SVI', batch_size=batch_size,
+                                                         num_steps=num_steps, chunk_size=chunk_size,
+                                                         early_stopping=early_stopping))
+        state, _ = run_steps(steps, state, num_steps, chunk_size, checkpoint=checkpoints,
+                             stop=plateau if early_stopping else None, loss_file=loss_file)
+        params = svi.get_params(state)
+        samples = guide.sample_posterior(random.PRNGKey(1), params, (1000,))
+        logger.info(r'SVI summary of the global latents for: {}'.format(model.__name__))
+        numpyro.diagnostics.print_summary({k: v for k, v in samples.items() if guide.sites[k][1] is None},
+                                          prob=0.90, group_by_chain=False)
     else:
         #SVI
         logger.info('Guide generation...')
         rng_key = random.PRNGKey(0)
         guide = AutoDiagonalNormal(model=model)
-        logger.info('Optimizer generation...')
-        optim = Adam(0.05)
+        plateau = Plateau(step_size=0.05)
         logger.info('SVI generation...')
-        svi = SVI(model, guide, optim, AutoContinuousELBO(), **inputs)
-        init_state = svi.init(rng_key)
-        logger.info('Scan...')
-        state, loss = lax.scan(lambda x,i: svi.update(x), init_state, np.zeros(2000))
+        svi = SVI(model, guide, Adam(plateau.step_size), AutoContinuousELBO(), **inputs)
+        state = svi.init(rng_key)
+        update = scheduled_update(svi, Adam)
+        # One compiled scan per chunk of steps
+        scan = jit(lambda state, steps, step_size: lax.scan(lambda x, i: update(x, step_size), state, steps))
+        checkpoints = None
+        if checkpoint is not None:
+            checkpoints = Checkpoint(checkpoint, run_key(model, inputs, method='SVI', num_steps=num_steps,
+                                                         chunk_size=chunk_size, early_stopping=early_stopping))
+        logger.info('SVI by chunks of {} steps...'.format(chunk_size))
+        state, loss = run_steps(lambda state, start, size: scan(state, np.zeros(size), plateau.step_size),
+                                state, num_steps, chunk_size, checkpoint=checkpoints,
+                                stop=plateau if early_stopping else None, loss_file=loss_file)
+        logger.info('SVI stopped after {} steps'.format(len(loss)))
         params = svi.get_params(state)
         samples = guide.sample_posterior(random.PRNGKey(1), params, (1000,))
         logger.info(r'SVI summary for: {}'.format(model.__name__))
         numpyro.diagnostics.print_summary(samples, prob=0.90, group_by_chain=False)
-    return samples
+    return cast(samples)
 
 
 def posterior_predictive(model, samples, inputs):
-    inputs_ = {k:inputs[k] for k in set(inputs.keys()).difference(['y'])}
+    if isinstance(getattr(model, '__self__', None), Model):
+        # Latent sites integrated out of the fit are drawn from their posterior, not their prior.
+        samples = model.__self__.posterior_samples(random.PRNGKey(1), samples, **cast(inputs))
+    inputs_ = cast({k:inputs[k] for k in set(inputs.keys()).difference(['y'])})
     predictive = Predictive(model=model, posterior_samples=samples)
     rng_key = random.PRNGKey(0)
     forecast = predictive(rng_key=rng_key, **inputs_)['obs']
     return forecast
 
+@partial(jit, static_argnums=(0, 1))
+def _predict(model, future, rng_keys, samples, X_test, X_train, y_train):
+    # Compiled once per model and horizon, batched over the posterior draws.
+    return vmap(lambda rng_key, sample: model.forecast(
+        future, rng_key, sample, X_test, X_train, y_train))(rng_keys, samples)
+
+
 def predict(model, samples, y_test, X_test, X_train, y_train):
+    samples, X_test, X_train, y_train = cast((samples, X_test, X_train, y_train))
     rng_keys = random.split(random.PRNGKey(3), samples["beta"].shape[0])
-    forecast_marginal = vmap(lambda rng_key, sample: model.forecast(
-        y_test.shape[0], rng_key, sample, X_test, X_train, y_train))(rng_keys, samples)
+    forecast_marginal = _predict(model, y_test.shape[0], rng_keys, samples, X_test, X_train, y_train)
     return forecast_marginal
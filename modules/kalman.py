@@ -0,0 +1,121 @@
+"""
+Kalman filter and simulation smoother of the local linear trend of
+:class:`modules.numpyro_models.HierarchicalLLM`, vectorised over items.
+
+Writing `D[t] = Z[t] - mu[t]`, `R[t]` the trend and `L[t]` the level, the state
+`x[t] = (D[t], R[t], L[t])` of every item follows
+
+    L[t] = L[t - 1] + e[t]
+    R[t] = R[t - 1] + L[t]
+    D[t] = alpha * D[t - 1] + R[t]
+    y[t] - mu[t] = D[t] + eps[t]
+
+with `x[0] = (0, 0, e[0])`, `e[t] ~ N(0, sigma_trend^2)` and `eps[t] ~ N(0, sigma_sto^2)`.
+The innovation `e[t]` loads every component of the state, and only the scalar
+innovation variance of the observation is inverted, so the degenerate state
+covariances of the first steps are not an issue.
+"""
+import math
+import jax.numpy as np
+from jax import lax, random
+
+_Z = np.array([1., 0., 0.])
+
+
+def transition(alpha):
+    """
+    Returns the `n_items x 3 x 3` transition matrices of the state `(D, R, L)`.
+    :param alpha: autoregressive coefficient of every item.
+    """
+    base = np.array([[0., 1., 1.], [0., 1., 1.], [0., 0., 1.]])
+    return base + alpha[:, None, None] * np.array([[1., 0., 0.], [0., 0., 0.], [0., 0., 0.]])
+
+
+def _init(sigma_trend):
+    n = sigma_trend.shape[0]
+    a = np.zeros((n, 3))
+    P = np.square(sigma_trend)[:, None, None] * np.array([[0., 0., 0.], [0., 0., 0.], [0., 0., 1.]])
+    return a, P
+
+
+def kalman_filter(y, alpha, sigma_trend, sigma_sto, mask=None):
+    """
+    Runs the Kalman filter of all items at once.
+    :param y: observations minus the covariate effect, `T x n_items`.
+    :param alpha: autoregressive coefficients, `n_items`.
+    :param sigma_trend: scale of the trend innovations, `n_items`.
+    :param sigma_sto: scale of the observation noise, `n_items`.
+    :param mask: boolean `T x n_items` array, False for the steps that are not observed.
+    :return: the log likelihood `T x n_items` of every step, and the innovations,
+        their variances and the Kalman gains, used by :func:`disturbance_smoother`.
+    """
+    F = transition(alpha)
+    q = np.square(sigma_trend)[:, None, None] * np.ones((3, 3))
+    h = np.square(sigma_sto)
+    mask = np.ones(y.shape, dtype=bool) if mask is None else mask
+
+    def _body_fn(carry, x):
+        a, P = carry
+        y_t, m_t = x
+        v = np.where(m_t, y_t - a[:, 0], 0.)
+        f = P[:, 0, 0] + h
+        K = np.where(m_t[:, None], np.einsum('nij,nj->ni', F, P[:, :, 0]) / f[:, None], 0.)
+        L = F - K[:, :, None] * _Z
+        a = np.einsum('nij,nj->ni', F, a) + K * v[:, None]
+        P = np.einsum('nij,njk,nlk->nil', F, P, L) + q
+        log_lik = np.where(m_t, -0.5 * (np.log(2 * math.pi * f) + np.square(v) / f), 0.)
+        return (a, P), (log_lik, v, f, K)
+
+    _, (log_lik, v, f, K) = lax.scan(_body_fn, _init(sigma_trend), (y, mask))
+    return log_lik, (v, f, K)
+
+
+def disturbance_smoother(alpha, sigma_trend, v, f, K):
+    """
+    Returns the smoothed initial state, `n_items x 3`, and the smoothed trend
+    innovations `e[1:]`, `(T - 1) x n_items`, from the output of :func:`kalman_filter`.
+    """
+    F = transition(alpha)
+    a, P = _init(sigma_trend)
+
+    def _body_fn(r, x):
+        v_t, f_t, K_t = x
+        e_t = np.square(sigma_trend) * np.sum(r, axis=-1)
+        L = F - K_t[:, :, None] * _Z
+        r = _Z * (v_t / f_t)[:, None] + np.einsum('nji,nj->ni', L, r)
+        return r, e_t
+
+    r, e = lax.scan(_body_fn, np.zeros(a.shape), (v, f, K), reverse=True)
+    return a + np.einsum('nij,nj->ni', P, r), e[:-1]
+
+
+def simulate(alpha, x_0, e):
+    """
+    Returns the states `T x n_items x 3` generated from the initial state `x_0` and
+    the trend innovations `e[1:]`.
+    """
+    F = transition(alpha)
+
+    def _body_fn(x, e_t):
+        x = np.einsum('nij,nj->ni', F, x) + e_t[:, None]
+        return x, x
+
+    _, states = lax.scan(_body_fn, x_0, e)
+    return np.concatenate([x_0[None], states], axis=0)
+
+
+def simulation_smoother(rng_key, y, alpha, sigma_trend, sigma_sto, mask=None):
+    """
+    Draws the states `T x n_items x 3` from their posterior given `y` (Durbin and
+    Koopman, 2002): states and observations are simulated from the prior, and the
+    simulated path is corrected by the smoothed disturbances of the residual.
+    Arguments are those of :func:`kalman_filter`.
+    """
+    l, n = y.shape
+    key_init, key_trend, key_sto = random.split(rng_key, 3)
+    x_0 = np.stack([np.zeros(n), np.zeros(n), sigma_trend * random.normal(key_init, (n,))], axis=-1)
+    e = sigma_trend * random.normal(key_trend, (l - 1, n))
+    y_sim = simulate(alpha, x_0, e)[..., 0] + sigma_sto * random.normal(key_sto, (l, n))
+    _, (v, f, K) = kalman_filter(y - y_sim, alpha, sigma_trend, sigma_sto, mask)
+    x_0_hat, e_hat = disturbance_smoother(alpha, sigma_trend, v, f, K)
+    return simulate(alpha, x_0 + x_0_hat, e + e_hat)
@@ -1,5 +1,6 @@
 import numpy as onp
 from numpyro.diagnostics import autocorrelation, hpdi
+from modules.precision import float_dtype
 
 class Metrics():
 
@@ -13,6 +14,8 @@ class Metrics():
         self.actual = None
         for name,value in kwargs.items():
             setattr(self,name,value)
+        self.trace = None if self.trace is None else onp.asarray(self.trace, dtype=float_dtype())
+        self.actual = None if self.actual is None else onp.asarray(self.actual, dtype=float_dtype())
 
     @property
     def moments(self):
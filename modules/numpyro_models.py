@@ -1,17 +1,43 @@
 import logging
 import jax.numpy as np
-from jax import lax
+import numpy as onp
+from jax import lax, random, vmap
+from jax.tree_util import tree_leaves
 import numpyro
 import numpyro.distributions as dist
 from numpyro import handlers
+from numpyro.util import not_jax_tracer
 from modules.metrics import Metrics
+from modules.covariates import covariate_effect
+from modules.kalman import kalman_filter, simulation_smoother
+from modules.scan import affine_scan, prefix_sum
 
 assert numpyro.__version__.startswith('0.2.4')
-numpyro.set_host_device_count(4)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 
 
+def start_index(y):
+    """
+    Returns the start index `brk` of every item: the first day whose sales differ from the
+    next day's, i.e. the end of the leading inactive period. Computed once from the training
+    data and passed to the models as `brk`, instead of on every log-density evaluation.
+    :param y: sales with shape `T x n_items`.
+    """
+    return onp.asarray((onp.diff(onp.asarray(y), n=1, axis=0) == 0).argmin(axis=0))
+
+
+def packed_index(brk, l):
+    """
+    Returns the flat indices, in a row-major `T x n_items` array, of the active entries
+    `t >= brk[i]`, and the item of every entry. Only the likelihood is packed: the latent
+    recursions of the models still run over all `T` days of every item.
+    """
+    brk = onp.asarray(brk)
+    t, item = onp.nonzero(onp.arange(l)[:, None] >= brk[None, :])
+    return t * brk.shape[0] + item, item
+
+
 class Model(object):
     """
     All models must have a numpyro model and a out of sample forecast method.
@@ -23,21 +49,72 @@ class Model(object):
     def forecast(self, **kwargs):
         raise NotImplementedError
 
+    def posterior_samples(self, rng_key, samples, X, y=None, brk=None, **kwargs):
+        """
+        Returns the posterior `samples` completed with the latent sites the fit integrated
+        out, for in-sample predictions; unchanged by default.
+        """
+        return samples
+
+    def start(self, y, brk=None):
+        """
+        Records the start index of every item, detected from `y` if not given as data.
+        """
+        if brk is None:
+            brk = (np.diff(y, n=1, axis=0) == 0).argmin(axis=0)
+        return numpyro.deterministic('brk', brk)
+
+    def subsample(self, n_items, size=None):
+        """
+        Rescales the log density of the item-level sites when the data hold a minibatch of
+        `n_items` out of `size` items, so that it is an unbiased estimate of the full one.
+        """
+        return handlers.scale(scale_factor=1. if size is None else size / n_items)
+
+    def observe(self, fn, y, brk=None, **params):
+        """
+        Samples or observes `obs` from `fn(**params)`, with `loc` of shape `T x n_items`.
+        Days before the start of every item are left out of the likelihood. When `brk` is given as
+        concrete data, the likelihood is only evaluated on the active entries, packed into a single
+        vector; otherwise they are masked out of the full `T x n_items` likelihood. Either way, `loc`
+        and the latent states it comes from are computed for all `T` days.
+        :return: the observations, or the sampled values if `y` is None.
+        """
+        l, n_items = params['loc'].shape
+        if y is not None and brk is not None and not_jax_tracer(brk):
+            self.start(y, brk)
+            index, _ = packed_index(brk, l)
+            params = {k: np.broadcast_to(v, (l, n_items)).reshape(-1)[index] for k, v in params.items()}
+            with numpyro.plate('active', index.shape[0]):
+                numpyro.sample('obs', fn=fn(**params), obs=y.reshape(-1)[index])
+            return y
+        with numpyro.plate('items', n_items):
+            with numpyro.plate('y', l):
+                if y is None:
+                    return numpyro.sample('obs', fn=fn(**params))
+                with handlers.mask(mask_array=np.arange(l)[..., None] >= self.start(y, brk)):
+                    return numpyro.sample('obs', fn=fn(**params), obs=y)
+
 
 class HierarchicalDrift(Model):
 
-    def __init__(self, X_dim):
+    def __init__(self, X_dim, scan_method='vectorised'):
         """
         HierarchicalModel parameters initialisation
         :param X_dim: dict with variable dimensions
+        :param scan_method: evaluation of the recursion of the fit, when y is observed: 'vectorised'
+            computes every step from the shifted observations, without a scan, and 'sequential' keeps
+            the scan, which `python -m benchmarks.scan` shows to be much slower. Draws without
+            observations and forecasts always scan.
         """
         self.X_dim = X_dim
+        self.scan_method = scan_method
         self.values = list(self.X_dim.values())
         self.n_cov = len(self.values)
         # Seasonality and regression effects
         self.l, self.n_, self.n_items = None, None, None
 
-    def model(self, X, y=None):
+    def model(self, X, y=None, brk=None, size=None):
         l, n_, n_items = X.shape
 
         if n_items > 1:
@@ -47,7 +124,7 @@ class HierarchicalDrift(Model):
             beta_meta = numpyro.deterministic('beta_meta', value=np.array(0.))
             sigma_meta = numpyro.deterministic('sigma_meta', value=np.array(1))
         # Plate over items
-        with numpyro.plate('items', n_items):
+        with numpyro.plate('items', n_items), self.subsample(n_items, size):
             sigma_sto = numpyro.sample('sigma_sto', fn=dist.HalfNormal(scale=0.5))
             # Plate over variables
             with numpyro.plate('n_cov', self.n_cov):
@@ -63,7 +140,7 @@ class HierarchicalDrift(Model):
                                                  fn=dist.TransformedDistribution(dist.Normal(loc=0., scale=1),
                                                                                  transforms=dist.transforms.AffineTransform(
                                                                                      loc=beta_long, scale=sigma_long)))
-            mu = np.matmul(X.transpose((-1, -3, -2)), beta_covariates.T[..., None]).sum(-1).T
+            mu = covariate_effect(X, beta_covariates)
             # Constant
             const = numpyro.sample('const', fn=dist.Normal(0, 15))
             C = np.repeat(const[None, ...], repeats=l, axis=0)
@@ -85,18 +162,20 @@ class HierarchicalDrift(Model):
                                                          rw=rw.T,
                                                          mu=mu,
                                                          dz=np.arange(l))
-            # Break detection
-            if y is not None:
-                brk = numpyro.deterministic('brk', (np.diff(y, n=1, axis=0) == 0).argmin(axis=0))
-            else:
-                brk = X.shape[0]
-            # Inference
-            with numpyro.plate('y', l):
-                with handlers.mask(np.arange(l)[..., None] < brk):
-                    obs = numpyro.sample('obs', fn=dist.Normal(loc=Z, scale=sigma_sto), obs=y)
-                    return z_last, mu_last, rw_last
+        # Inference
+        with self.subsample(n_items, size):
+            self.observe(dist.Normal, y, brk, loc=Z, scale=sigma_sto)
+        return z_last, mu_last, rw_last
 
     def scan_fn(self, alpha, z_init, mu_0, rw_0, y, rw, mu, dz):
+        if y is not None and self.scan_method != 'sequential':
+            # With observations every step only depends on y, mu and rw at the previous step,
+            # so Z is computed from shifted arrays (indices clamped as in the scan body).
+            y_, mu_, rw_ = [v[np.minimum(dz, v.shape[0] - 1)] for v in (y, mu, rw)]
+            y_prev = np.concatenate([z_init[None], y_[:-1]], axis=0)
+            mu_prev = np.concatenate([mu_0[None], mu_[:-1]], axis=0)
+            Z = np.multiply(alpha, (y_prev - mu_prev)) + mu_ + rw_
+            return (y_[-1], mu_[-1], rw_[-1]), Z
         if y is not None:
             def _body_fn(carry, x):
                 z_prev, x_, rw_ = carry
@@ -109,42 +188,51 @@ class HierarchicalDrift(Model):
                 return (mu[x], mu[x], rw[x]), z_t
         return lax.scan(_body_fn, (z_init, mu_0, rw_0), dz)
 
-    def _forecast(self, future, sample, X, z_last, mu_last, rw_last):
-        mu = (np.matmul(X.transpose((-1, -3, -2)),
-                        sample['beta_covariates'].T[..., None])
-              .sum(-1).T + sample['const'])
-        for t in range(future):
-            # logger.info(f'forecasting iteration: {t}')
-            rw_ = numpyro.sample(f"rw[{t}]", dist.Normal(rw_last, sample['sigma_rw']))
+    def _forecast(self, future, rng_key, sample, X, z_last, mu_last, rw_last):
+        mu = covariate_effect(X, sample['beta_covariates']) + sample['const']
+
+        def _body_fn(carry, t):
+            # Keys are split as the `seed` handler does for the sites rw[t] then yf[t].
+            rng_key, z_last, mu_last, rw_last = carry
+            rng_key, key_rw = random.split(rng_key)
+            rng_key, key_y = random.split(rng_key)
+            rw_ = dist.Normal(rw_last, sample['sigma_rw']).sample(key_rw)
             mu_ = np.multiply(sample['alpha'], z_last - mu_last) + mu[t]
             mean_ = mu_ + rw_
-            y_ = numpyro.sample(f"yf[{t}]", dist.Normal(mean_, sample['sigma_sto']))
-            z_last, mu_last, rw_last = y_, mu_, rw_
+            y_ = dist.Normal(mean_, sample['sigma_sto']).sample(key_y)
+            return (rng_key, y_, mu_, rw_), y_
+
+        _, yf = lax.scan(_body_fn, (rng_key, z_last, mu_last, rw_last), np.arange(future))
+        return numpyro.deterministic('yf', yf)
 
     def forecast(self, future, rng_key, sample, X_test, X_train, y):
         z_last, mu_last, rw_last = handlers.substitute(self.model, sample)(X_train, y)
-        forecast_model = handlers.seed(self._forecast, rng_key)
-        forecast_trace = handlers.trace(forecast_model).get_trace(future, sample, X_test, z_last, mu_last, rw_last)
-        results = [np.clip(forecast_trace[f"yf[{t}]"]["value"], a_min=1e-30)
-                   for t in range(future)]
-        return np.stack(results, axis=0)
+        yf = self._forecast(future, rng_key, sample, X_test, z_last, mu_last, rw_last)
+        return np.clip(yf, a_min=1e-30)
 
 
 class HierarchicalLLM(Model):
 
-    def __init__(self, X_dim):
+    def __init__(self, X_dim, scan_method='associative', marginalize_trend=False):
         """
         HierarchicalModel parameters initialisation
         :param rw: Include random walk term ?
         :param X_dim: dict with variable dimensions
+        :param scan_method: 'associative' (parallel prefix) or 'sequential' evaluation of the recursions
+        :param marginalize_trend: integrate the stochastic trend out with a Kalman filter when y is
+            observed, instead of sampling its `T x n_items` innovations. Both are the state space model
+            of :mod:`modules.kalman`, with `rw[t]` the innovation of the level on day t. The fit then
+            holds no `rw`, which :meth:`posterior_samples` draws with the simulation smoother.
         """
         self.X_dim = X_dim
+        self.scan_method = scan_method
+        self.marginalize_trend = marginalize_trend
         self.values = list(self.X_dim.values())
         self.n_cov = len(self.values)
         # Seasonality and regression effects
         self.l, self.n_, self.n_items = None, None, None
 
-    def model(self, X, y=None):
+    def model(self, X, y=None, brk=None, size=None):
         l, n_, n_items = X.shape
 
         if n_items > 1:
@@ -154,7 +242,7 @@ class HierarchicalLLM(Model):
             beta_meta = numpyro.deterministic('beta_meta', value=np.array(0.))
             sigma_meta = numpyro.deterministic('sigma_meta', value=np.array(1))
         # Plate over items
-        with numpyro.plate('items', n_items):
+        with numpyro.plate('items', n_items), self.subsample(n_items, size):
             sigma_sto = numpyro.sample('sigma_sto', fn=dist.HalfNormal(scale=0.1))
             # Plate over variables
             with numpyro.plate('n_cov', self.n_cov):
@@ -170,43 +258,58 @@ class HierarchicalLLM(Model):
                                                  fn=dist.TransformedDistribution(dist.Normal(loc=0., scale=1),
                                                                                  transforms=dist.transforms.AffineTransform(
                                                                                      loc=beta_long, scale=sigma_long)))
-            mu = np.matmul(X.transpose((-1, -3, -2)), beta_covariates.T[..., None]).sum(-1).T
+            mu = covariate_effect(X, beta_covariates)
             # Constant
             const = numpyro.sample('const', fn=dist.Normal(0, 5))
             C = np.repeat(const[None, ...], repeats=l, axis=0)
             mu += C
             # Stochastic Trend
             sigma_trend = numpyro.sample('sigma_trend', fn=dist.HalfNormal(0.002))
-            with numpyro.plate('rw_plate', l):
-                rw = numpyro.sample('rw', fn=dist.TransformedDistribution(dist.Normal(loc=0., scale=1),
-                                                                          transforms=dist.transforms.AffineTransform(
-                                                                              loc=0, scale=sigma_trend)))
+            marginal = self.marginalize_trend and y is not None
+            if not marginal:
+                with numpyro.plate('rw_plate', l):
+                    rw = numpyro.sample('rw', fn=dist.TransformedDistribution(dist.Normal(loc=0., scale=1),
+                                                                              transforms=dist.transforms.AffineTransform(
+                                                                                  loc=0, scale=sigma_trend)))
             # Autoregressive component
             alpha = numpyro.sample(name="alpha", fn=dist.TransformedDistribution(dist.Normal(loc=0., scale=1.),
                                                                                  transforms=dist.transforms.AffineTransform(
                                                                                      loc=0.0, scale=0.5,
                                                                                      domain=dist.constraints.interval(
                                                                                          -1, 1))))
+            if marginal:
+                # Gaussian trend integrated out, see modules.kalman
+                brk = self.start(y, brk)
+                log_lik, _ = kalman_filter(y - mu, alpha, sigma_trend, sigma_sto,
+                                           mask=np.arange(l)[..., None] >= brk)
+                numpyro.factor('obs', log_lik.sum(axis=0))
+                return
+            # Day t adds the innovation rw[t] to the level, as in modules.kalman.
             (z_prev, mu_prev, llw_prev, rw_prev), Z = self.scan_fn(alpha=alpha,
                                                                    mu_0=mu[0],
                                                                    llm_0=rw[0],
                                                                    rw_0=np.zeros((n_items,)),
-                                                                   llm=rw[1:],
-                                                                   mu=mu[1:],
+                                                                   llm=rw,
+                                                                   mu=mu,
                                                                    dz=np.arange(1, l))
             Z = np.concatenate([mu[0].reshape(-1, n_items), Z], axis=0)
-            # Break detection
-            if y is not None:
-                brk = numpyro.deterministic('brk', (np.diff(y, n=1, axis=0) == 0).argmin(axis=0))
-            else:
-                brk = X.shape[0]
-            # Inference
-            with numpyro.plate('y', l):
-                with handlers.mask(np.arange(l)[..., None] < brk):
-                    obs = numpyro.sample('obs', fn=dist.Normal(loc=Z, scale=sigma_sto), obs=y)
-                    return z_prev, mu_prev, rw_prev
+        # Inference
+        with self.subsample(n_items, size):
+            self.observe(dist.Normal, y, brk, loc=Z, scale=sigma_sto)
+        return z_prev, mu_prev, rw_prev
 
     def scan_fn(self, alpha, mu_0, llm_0, rw_0, llm, mu, dz):
+        if self.scan_method != 'sequential':
+            # Both trends are cumulative sums and z_t = alpha * z_{t-1} + (mu_t - alpha * mu_{t-1} + rw_t),
+            # over the same steps `llm[x]`, `mu[x]` as the sequential body (indices are clamped to the last step).
+            steps = np.minimum(dz, mu.shape[0] - 1)
+            llm, mu = llm[steps], mu[steps]
+            llm_ = llm_0 + prefix_sum(llm)
+            rw_ = rw_0 + prefix_sum(llm_)
+            mu_prev = np.concatenate([mu_0[None], mu[:-1]], axis=0)
+            Z = affine_scan(alpha, mu - np.multiply(alpha, mu_prev) + rw_, mu_0)
+            return (Z[-1], mu[-1], llm_[-1], rw_[-1]), Z
+
         def _body_fn(carry, x):
             z_prev, x_, llm_, rw_ = carry
             llm_ += llm[x]
@@ -217,38 +320,77 @@ class HierarchicalLLM(Model):
 
         return lax.scan(_body_fn, (mu_0, mu_0, llm_0, rw_0), dz)
 
-    def _forecast(self, future, sample, X, z_prev, mu_prev, rw_prev):
+    def _forecast(self, future, rng_key, sample, X, z_prev, mu_prev, rw_prev):
         beta = sample['beta_covariates']
-        mu = np.matmul(X.transpose((-1, -3, -2)), beta.T[..., None]).sum(-1).T + sample['const']
-        for t in range(future):
-            rw_ = numpyro.sample(f"rw[{t}]", dist.Normal(0.0, sample['sigma_trend']))
+        mu = covariate_effect(X, beta) + sample['const']
+
+        def _body_fn(carry, t):
+            # Keys are split as the `seed` handler does for the sites rw[t] then yf[t].
+            rng_key, z_prev, mu_prev, rw_prev = carry
+            rng_key, key_rw = random.split(rng_key)
+            rng_key, key_y = random.split(rng_key)
+            rw_ = dist.Normal(0.0, sample['sigma_trend']).sample(key_rw)
             z_ = np.multiply(sample['alpha'], z_prev - mu_prev) + mu[t] + rw_ + rw_prev
-            yf = numpyro.sample(f"yf[{t}]", dist.Normal(z_, sample['sigma_sto']))
-            rw_prev, z_prev, mu_prev = rw_ + rw_prev, yf, mu[t]
+            yf = dist.Normal(z_, sample['sigma_sto']).sample(key_y)
+            return (rng_key, yf, mu[t], rw_ + rw_prev), yf
 
-    def forecast(self, future, rng_key, sample, X_test, X_train, y):
-        z_prev, mu_prev, rw_prev = handlers.substitute(self.model, sample)(X_train, y)
-        forecast_model = handlers.seed(self._forecast, rng_key)
-        forecast_trace = handlers.trace(forecast_model).get_trace(future, sample, X_test, z_prev, mu_prev, rw_prev)
-        results = [np.clip(forecast_trace[f"yf[{t}]"]["value"], a_min=1e-30)
-                   for t in range(future)]
-        return np.stack(results, axis=0)
+        _, yf = lax.scan(_body_fn, (rng_key, z_prev, mu_prev, rw_prev), np.arange(future))
+        return numpyro.deterministic('yf', yf)
+
+    def smooth(self, rng_key, sample, X, y, brk=None):
+        """
+        Draws the states `(Z - mu, trend, level)` with shape `T x n_items x 3` from their
+        posterior given `y` and the parameters in `sample`, with the simulation smoother.
+        Days before the start of every item are not observed, as in the likelihood.
+        Used to recover the trend when it is marginalised; batch it over draws with `vmap`.
+        """
+        l = y.shape[0]
+        mu = covariate_effect(X, sample['beta_covariates']) + sample['const']
+        return simulation_smoother(rng_key, y - mu, sample['alpha'], sample['sigma_trend'], sample['sigma_sto'],
+                                   mask=np.arange(l)[:, None] >= self.start(y, brk))
+
+    def posterior_samples(self, rng_key, samples, X, y=None, brk=None, **kwargs):
+        """
+        With a marginalised trend, adds to `samples` the level innovations `rw` of the
+        states drawn by :meth:`smooth`, one path per draw, so that the in-sample predictions
+        follow the smoothed trend rather than its prior.
+        """
+        if not self.marginalize_trend or 'rw' in samples:
+            return samples
+        n = tree_leaves(samples)[0].shape[0]
+        level = vmap(lambda rng_key, sample: self.smooth(rng_key, sample, X, y, brk))(
+            random.split(rng_key, n), samples)[..., 2]
+        return {**samples, 'rw': np.concatenate([level[:, :1], np.diff(level, axis=1)], axis=1)}
+
+    def forecast(self, future, rng_key, sample, X_test, X_train, y, brk=None):
+        if self.marginalize_trend:
+            rng_key, key_trend = random.split(rng_key)
+            state = self.smooth(key_trend, sample, X_train, y, brk)[-1]
+            mu_prev = covariate_effect(X_train[-1:], sample['beta_covariates'])[0] + sample['const']
+            z_prev, rw_prev = mu_prev + state[:, 0], state[:, 1]
+        else:
+            z_prev, mu_prev, rw_prev = handlers.substitute(self.model, sample)(X_train, y)
+        yf = self._forecast(future, rng_key, sample, X_test, z_prev, mu_prev, rw_prev)
+        return np.clip(yf, a_min=1e-30)
 
 
 class HierarchicalMeanReverting(Model):
 
-    def __init__(self, X_dim):
+    def __init__(self, X_dim, scan_method='sequential'):
         """
         HierarchicalModel parameters initialisation
         :param X_dim: dict with variable dimensions
+        :param scan_method: 'sequential' or 'associative' (parallel prefix) evaluation of the recursion.
+            Its single affine step makes the sequential scan the faster one, see `python -m benchmarks.scan`.
         """
         self.X_dim = X_dim
+        self.scan_method = scan_method
         self.values = list(self.X_dim.values())
         self.n_cov = len(self.values)
         # Seasonality and regression effects
         self.l, self.n_, self.n_items = None, None, None
 
-    def model(self, X, y=None):
+    def model(self, X, y=None, brk=None, size=None):
         l, n_, n_items = X.shape
 
         if n_items > 1:
@@ -258,7 +400,7 @@ class HierarchicalMeanReverting(Model):
             beta_meta = numpyro.deterministic('beta_meta', value=np.array(0.))
             sigma_meta = numpyro.deterministic('sigma_meta', value=np.array(0.4))
         # Plate over items
-        with numpyro.plate('items', n_items):
+        with numpyro.plate('items', n_items), self.subsample(n_items, size):
             dof = numpyro.sample("dof", dist.Uniform(1, 50))
             sigma_sto = numpyro.sample('sigma_sto', fn=dist.HalfNormal(scale=0.1))
             const = numpyro.sample('const', fn=dist.HalfNormal(2))
@@ -277,25 +419,22 @@ class HierarchicalMeanReverting(Model):
                                                  fn=dist.TransformedDistribution(dist.Normal(loc=0., scale=1),
                                                                                  transforms=dist.transforms.AffineTransform(
                                                                                      loc=beta_long, scale=sigma_long)))
-            mu = np.matmul(X.transpose((-1, -3, -2)), beta_covariates.T[..., None]).sum(-1).T
+            mu = covariate_effect(X, beta_covariates)
             mu += C
             # Autoregressive component
             alpha = numpyro.sample(name="alpha", fn=dist.TransformedDistribution(dist.Normal(loc=0., scale=1.),
                                                                                  transforms=dist.transforms.AffineTransform(
                                                                                      loc=0.5, scale=0.3)))
             _, Z = self.scan_fn(alpha, np.zeros(shape=(n_items,)), mu)
-            # Break detection
-            if y is not None:
-                brk = numpyro.deterministic('brk', (np.diff(y, n=1, axis=0) == 0).argmin(axis=0))
-            else:
-                brk = X.shape[0]
-            # Inference
-            with numpyro.plate('y', l):
-                with handlers.mask(np.arange(l)[..., None] < brk):
-                    obs = numpyro.sample('obs', fn=dist.StudentT(df=dof, loc=Z, scale=sigma_sto), obs=y)
-                    return obs
+        # Inference
+        with self.subsample(n_items, size):
+            return self.observe(dist.StudentT, y, brk, df=dof, loc=Z, scale=sigma_sto)
 
     def scan_fn(self, alpha, z_init, dz):
+        if self.scan_method != 'sequential':
+            Z = affine_scan(alpha, np.multiply((np.ones(alpha.shape) - alpha), dz), z_init)
+            return Z[-1], Z
+
         def _body_fn(carry, x):
             z_prev = carry
             z_t = np.multiply(alpha, z_prev) + np.multiply((np.ones(alpha.shape) - alpha), x)
@@ -304,23 +443,27 @@ class HierarchicalMeanReverting(Model):
 
         return lax.scan(_body_fn, z_init, dz)
 
-    def _forecast(self, future, sample, X, last):
+    def _forecast(self, future, rng_key, sample, X, last):
         beta = sample['beta_covariates']
-        mu = np.matmul(X.transpose((-1, -3, -2)), beta.T[..., None]).sum(-1).T + sample['const']
+        mu = covariate_effect(X, beta) + sample['const']
         last_ = np.mean(last)
         one = np.ones(last.shape[-1])
-        for t in range(future):
+
+        def _body_fn(carry, t):
+            # Keys are split as the `seed` handler does for the sites yf[t].
+            rng_key, last_ = carry
+            rng_key, key_y = random.split(rng_key)
             z = np.multiply(sample['alpha'], last_) + np.multiply((one - sample['alpha']), mu[t])
-            yf = numpyro.sample(f"yf[{t}]", dist.StudentT(sample['dof'], z, sample['sigma_sto']))
-            last_ = z
+            yf = dist.StudentT(sample['dof'], z, sample['sigma_sto']).sample(key_y)
+            return (rng_key, z), yf
+
+        _, yf = lax.scan(_body_fn, (rng_key, last_ * one), np.arange(future))
+        return numpyro.deterministic('yf', yf)
 
     def forecast(self, future, rng_key, sample, X, y):
         last = handlers.substitute(self.model, sample)(X, y)
-        forecast_model = handlers.seed(self._forecast, rng_key)
-        forecast_trace = handlers.trace(forecast_model).get_trace(future, sample, X, last)
-        results = [np.clip(forecast_trace[f"yf[{t}]"]["value"], a_min=1e-30)
-                   for t in range(future)]
-        return np.stack(results, axis=0)
+        yf = self._forecast(future, rng_key, sample, X, last)
+        return np.clip(yf, a_min=1e-30)
 
 
 #######################
@@ -0,0 +1,132 @@
+import copy
+import logging
+import numpy as onp
+
+logger = logging.getLogger()
+
+
+class Plateau(object):
+    """
+    Convergence test and step size schedule of an optimisation run by chunks of steps, see
+    :func:`run_steps`. The loss is smoothed by an exponential moving average; it has reached
+    a plateau when the smoothed loss decreased by less than `rtol` of its value over the last
+    `window` steps. The step size is then multiplied by `factor`, so that a stochastic
+    optimisation settles closer to the optimum, and the run stops at the first plateau after
+    `max_reductions` reductions, or as soon as the loss is not finite.
+
+    :param float step_size: initial step size.
+    :param int window: number of steps over which the decrease of the smoothed loss is measured.
+    :param float rtol: relative decrease of the smoothed loss below which it has reached a plateau.
+    :param float smoothing: weight of the past in the moving average, in `[0, 1)`.
+    :param float factor: factor of the step size at a plateau.
+    :param int max_reductions: number of reductions of the step size before stopping.
+    """
+
+    def __init__(self, step_size=0.05, window=200, rtol=1e-3, smoothing=0.98, factor=0.5, max_reductions=2):
+        self.step_size = step_size
+        self.window = window
+        self.rtol = rtol
+        self.smoothing = smoothing
+        self.factor = factor
+        self.max_reductions = max_reductions
+        self.reductions = 0
+        self.smoothed = []
+        self._since = 0
+
+    def __call__(self, losses):
+        """
+        Updates the test with the losses of the last chunk of steps and returns whether the
+        run should stop.
+        """
+        for loss in onp.asarray(losses, dtype=onp.float64):
+            self.smoothed.append(loss if not self.smoothed else
+                                 self.smoothing * self.smoothed[-1] + (1 - self.smoothing) * loss)
+        step = len(self.smoothed)
+        if not onp.isfinite(self.smoothed[-1]):
+            logger.warning('The loss is not finite at step {}, stopping'.format(step))
+            return True
+        # The window only starts at the last change of step size.
+        if step - self._since <= self.window:
+            return False
+        if self.smoothed[-self.window - 1] - self.smoothed[-1] >= self.rtol * abs(self.smoothed[-1]):
+            return False
+        if self.reductions == self.max_reductions:
+            logger.info('The loss reached a plateau at step {}, stopping'.format(step))
+            return True
+        self.reductions += 1
+        self.step_size *= self.factor
+        self._since = step
+        logger.info('The loss reached a plateau at step {}, step size reduced to {:g}'.format(step, self.step_size))
+        return False
+
+
+def scheduled_update(svi, optim):
+    """
+    Returns the update of `svi` with the optimiser `optim(step_size)`, as a function
+    `update(state, step_size, *args, **kwargs)`. The step size is an argument of the compiled
+    update rather than a constant of it, so that changing it, e.g. on a :class:`Plateau`,
+    does not recompile the update.
+    :param svi: `numpyro.infer.SVI` after `SVI.init`.
+    :param callable optim: optimiser class of `svi`, e.g. `numpyro.optim.Adam`.
+    """
+    def update(state, step_size, *args, **kwargs):
+        svi_ = copy.copy(svi)
+        svi_.optim = optim(step_size)
+        return svi_.update(state, *args, **kwargs)
+
+    return update
+
+
+def _write_losses(path, start, losses, mode='a'):
+    with open(path, mode) as f:
+        if mode == 'w':
+            f.write('step,loss\n')
+        onp.savetxt(f, onp.column_stack([onp.arange(start, start + len(losses)), losses]),
+                    fmt=['%d', '%.6g'], delimiter=',')
+
+
+def run_steps(step_fn, state, num_steps, interval=100, checkpoint=None, stop=None, loss_file=None):
+    """
+    Runs up to `num_steps` optimisation steps by chunks of `interval` steps, each of which is
+    typically a single compiled program. Between chunks, the losses of the chunk are passed to
+    `stop`, appended to `loss_file` and, with a checkpoint, saved with the state. A run from a
+    checkpoint resumes at its last chunk, with `stop` updated with the losses saved before it.
+    :param callable step_fn: `step_fn(state, start, size)` runs `size` steps from step `start`
+        and returns the new state and their losses.
+    :param state: initial state, e.g. the `SVIState` returned by `SVI.init`.
+    :param int num_steps: maximum number of steps.
+    :param int interval: number of steps per chunk.
+    :param checkpoint: :class:`modules.checkpoint.Checkpoint` of the run, or None.
+    :param callable stop: called with the losses of every chunk, returns True to stop the run
+        early, e.g. a :class:`Plateau`.
+    :param str loss_file: csv file where the loss of every step is written as the run goes.
+    :return: the last state and the losses of all steps.
+    """
+    start, losses = 0, []
+    restored = None if checkpoint is None else checkpoint.load_state(lambda: state)
+    if restored is None:
+        if checkpoint is not None:
+            checkpoint.clear()
+    else:
+        state, start = restored
+        losses = [values['loss'] for _, values in checkpoint.iter_chunks(start)]
+        logger.info('Resuming from step {} of {}'.format(start, num_steps))
+    if loss_file is not None:
+        _write_losses(loss_file, 0, onp.concatenate(losses) if losses else onp.zeros(0), mode='w')
+    done = False
+    for chunk in losses:
+        done = stop is not None and stop(chunk)
+    while not done and start < num_steps:
+        size = min(interval, num_steps - start)
+        state, chunk = step_fn(state, start, size)
+        chunk = onp.asarray(chunk)
+        losses.append(chunk)
+        if checkpoint is not None:
+            checkpoint.save_chunk(start, {'loss': chunk})
+            checkpoint.save_state(state, start + size)
+        if loss_file is not None:
+            _write_losses(loss_file, start, chunk)
+        logger.info('Steps {} to {}: mean loss={:.1f}'.format(start, start + size, float(onp.mean(chunk))))
+        start += size
+        done = stop is not None and stop(chunk)
+    return state, onp.concatenate(losses) if losses else onp.zeros(0)
@@ -0,0 +1,128 @@
+import inspect
+import logging
+import os
+import re
+import shutil
+import time
+import numpy as np
+from modules.cache import ColumnarCache, memo
+from modules.features import digest
+
+logger = logging.getLogger()
+
+
+def code_key(*objects):
+    """
+    Returns the hash of the source of the modules defining `objects`, to add to the key of
+    a source stage whose function only wraps a loader: the signature of the stage covers
+    the code of the wrapper, not the code that reads the data.
+    """
+    sources = []
+    for obj in objects:
+        try:
+            sources.append(inspect.getsource(obj if inspect.ismodule(obj) else inspect.getmodule(obj)))
+        except (OSError, TypeError):
+            sources.append(None)
+    return digest(*sources)
+
+
+class Stage:
+    """
+    A step of a :class:`Pipeline`. A transform stage applies `fn(value, *args)` to each
+    of the listed covariates, as :func:`modules.transform.transform` does. A source
+    stage (`names=None`) produces the data itself with `fn(*args, **kwargs)`.
+
+    :param callable fn: function of the stage.
+    :param list names: names of the transformed covariates, `None` for a source stage.
+    :param args: positional parameters of `fn`.
+    :param key: json-serializable signature of the data read by a source stage, e.g.
+        the size and mtime of its files and the :func:`code_key` of its loader, so that
+        its output is rebuilt when they change.
+    :param kwargs: keyword parameters of `fn`.
+    """
+
+    def __init__(self, fn, names, *args, key=None, **kwargs):
+        self.fn = fn
+        self.names = names
+        self.args = args
+        self.kwargs = kwargs
+        self.key = key
+
+    @property
+    def name(self):
+        return self.fn.__name__
+
+    def signature(self):
+        try:
+            code = inspect.getsource(self.fn)
+        except (OSError, TypeError):
+            code = None
+        return [self.fn.__module__, self.fn.__qualname__, code, self.names,
+                list(self.args), self.kwargs, self.key]
+
+    def apply(self, data):
+        if self.names is None:
+            return self.fn(*self.args, **self.kwargs)
+        return {name: self.fn(data[name], *self.args, **self.kwargs)
+                for name in self.names if name in data}
+
+
+class Pipeline:
+    """
+    A chain of :class:`Stage` whose outputs are cached on disk. Every stage is keyed
+    on the hash of its function, parameters and the key of the stage before it, so
+    changing a stage only recomputes that stage and the ones after it; the outputs
+    of upstream stages are memory-mapped from their caches. Only the covariates
+    written by a stage are stored with it, and a recomputed stage replaces the
+    caches of its previous keys.
+
+    :param list stages: stages, starting with a source stage.
+    :param str path: folder holding the stage caches.
+    """
+
+    def __init__(self, stages, path):
+        self.stages = stages
+        self.path = path
+        self.timings = []
+
+    def keys(self):
+        """
+        Returns the chained key of every stage.
+        """
+        keys, key = [], None
+        for stage in self.stages:
+            key = digest(key, stage.signature())
+            keys.append(key)
+        return keys
+
+    def run(self):
+        """
+        Runs the pipeline and returns the dict of data. Per-stage timings are logged
+        and kept in `timings` as `(stage name, 'cached' or 'computed', seconds)`.
+        """
+        data = {}
+        self.timings = []
+        for i, (stage, key) in enumerate(zip(self.stages, self.keys())):
+            start = time.perf_counter()
+            cache = ColumnarCache(os.path.join(self.path, "{}-{}-{}".format(i, stage.name, key)), key=key)
+            if cache.is_valid():
+                status = 'cached'
+                outputs = {name: memo.get(cache, name, lambda name=name: cache.load(name))
+                           for name in cache.columns}
+            else:
+                status = 'computed'
+                outputs = stage.apply(data)
+                cache.save({name: np.asarray(value) for name, value in outputs.items()})
+                self._prune(i, stage.name, key)
+            data.update(outputs)
+            self.timings.append((stage.name, status, time.perf_counter() - start))
+            logger.info('Stage {} ({}): {} in {:.3f}s'.format(i, stage.name, status, self.timings[-1][-1]))
+        return data
+
+    def _prune(self, i, name, key):
+        # Removes the caches of stage i left by its previous keys.
+        pattern = re.compile(r'{}-{}-(\w+)$'.format(i, re.escape(name)))
+        for folder in os.listdir(self.path):
+            match = pattern.match(folder)
+            if match is not None and match.group(1) != key:
+                shutil.rmtree(os.path.join(self.path, folder), ignore_errors=True)
@@ -0,0 +1,43 @@
+import numpy as onp
+import jax.numpy as np
+import numpyro
+from jax.tree_util import tree_map
+
+_dtypes = {'float32': onp.float32, 'float64': onp.float64}
+_precision = {'dtype': onp.float32}
+
+
+def set_precision(precision='float32'):
+    """
+    Sets the floating point precision of the numpyro pipeline: data, latent variables and
+    stored posterior samples. 'float64' enables the x64 mode of jax, for numerical
+    diagnostics; call it before creating any jax array.
+    :param str precision: 'float32' or 'float64'.
+    """
+    if precision not in _dtypes:
+        raise ValueError("Unknown precision '{}'".format(precision))
+    numpyro.enable_x64(precision == 'float64')
+    _precision['dtype'] = _dtypes[precision]
+
+
+def float_dtype():
+    """
+    Returns the floating point dtype set by :func:`set_precision`.
+    """
+    return _precision['dtype']
+
+
+def cast(data):
+    """
+    Casts the floating point arrays of a pytree, e.g. a dict of inputs or of samples,
+    to the current precision. Integer arrays, such as categorical codes or start
+    indices, are left unchanged.
+    """
+    dtype = float_dtype()
+
+    def _cast(x):
+        if not hasattr(x, 'dtype') or not onp.issubdtype(x.dtype, onp.floating) or x.dtype == dtype:
+            return x
+        return x.astype(dtype) if isinstance(x, onp.ndarray) else np.asarray(x, dtype=dtype)
+
+    return tree_map(_cast, data)
@@ -52,7 +52,7 @@ class Model2(ForecastingModel):
             # We'll use a reparameterizer to improve variational fit. The model would still be
             # correct if you removed this context manager, but the fit appears to be worse.
             with poutine.reparam(config={"drift": LocScaleReparam()}):
-                drift = pyro.sample("drift", dist.Normal(zero_data.double(), drift_scale.double()).to_event(1))
+                drift = pyro.sample("drift", dist.Normal(zero_data, drift_scale).to_event(1))
 
         # After we sample the iid "drift" noise we can combine it in any time-dependent way.
         # It is important to keep everything inside the plate independent and apply dependent
@@ -84,7 +84,7 @@ class Model3(ForecastingModel):
             # We'll use a reparameterizer to improve variational fit. The model would still be
             # correct if you removed this context manager, but the fit appears to be worse.
             with poutine.reparam(config={"drift": LocScaleReparam()}):
-                drift = pyro.sample("drift", dist.Normal(zero_data.double(), drift_scale.double()).to_event(1))
+                drift = pyro.sample("drift", dist.Normal(zero_data, drift_scale).to_event(1))
 
         # After we sample the iid "drift" noise we can combine it in any time-dependent way.
         # It is important to keep everything inside the plate independent and apply dependent
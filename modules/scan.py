@@ -0,0 +1,73 @@
+import jax.numpy as np
+from jax import lax
+
+
+def _shift(x, k, fill):
+    """
+    Shifts `x` by `k` steps along the time axis, filling the first `k` steps with `fill`.
+    """
+    pad = np.full((k,) + x.shape[1:], fill, dtype=x.dtype)
+    return np.concatenate([pad, x[:-k]], axis=0)
+
+
+def affine_scan(a, b, z_init=None, method='associative'):
+    """
+    Evaluates the first-order affine recursion `z[t] = a[t] * z[t - 1] + b[t]`, with
+    `z[-1] = z_init`, for all `t` along the first axis.
+
+    The 'associative' method composes the affine maps `z -> a * z + b` by recursive
+    doubling: after `ceil(log2(T))` vectorised steps every `t` holds the composition
+    of the maps `0..t`. Its sequential depth is logarithmic in `T` instead of linear,
+    at the cost of `O(T log T)` work. The 'sequential' method runs the same recursion
+    with `lax.scan` and is kept for verification.
+    :param a: coefficients with shape `T x ...`, or broadcastable to `b[0]` if constant in time.
+    :param b: offsets with shape `T x ...`.
+    :param z_init: initial value, broadcastable to `b[0]`, zero if not given.
+    :param str method: 'associative' or 'sequential'.
+    :return: array with the shape of `b`.
+    """
+    l = b.shape[0]
+    constant = np.ndim(a) < np.ndim(b)
+    if method == 'sequential':
+        if constant:
+            a = np.broadcast_to(a, b.shape)
+
+        def _body_fn(z_prev, x):
+            a_t, b_t = x
+            z_t = a_t * z_prev + b_t
+            return z_t, z_t
+
+        z_init = np.zeros(b.shape[1:], dtype=b.dtype) if z_init is None else z_init * np.ones(b.shape[1:])
+        return lax.scan(_body_fn, z_init, (a, b))[1]
+    if method != 'associative':
+        raise ValueError("Unknown scan method '{}'".format(method))
+    if z_init is not None:
+        # Folding the initial value into the first offset avoids multiplying it by the
+        # products of `a`, which may overflow when the recursion is explosive.
+        b = np.concatenate([((a if constant else a[0]) * z_init + b[0])[None], b[1:]], axis=0)
+    k = 1
+    while k < l:
+        # After this step b[t] holds the composition of the maps t - 2k + 1..t; when `a` is
+        # constant in time the coefficient of the map t - k is simply a ** k.
+        b = a * _shift(b, k, 0) + b
+        if 2 * k < l:
+            a = a * a if constant else a * _shift(a, k, 1)
+        k *= 2
+    return b
+
+
+def prefix_sum(x, method='associative'):
+    """
+    Cumulative sum of `x` along the first axis. With the 'associative' method it runs in
+    `ceil(log2(T))` vectorised steps, as `np.cumsum` is lowered to a quadratic
+    `reduce_window` by this version of jax.
+    :param x: array with shape `T x ...`.
+    :param str method: 'associative' or 'sequential'.
+    """
+    if method == 'sequential':
+        return affine_scan(np.ones((), dtype=x.dtype), x, method=method)
+    k = 1
+    while k < x.shape[0]:
+        x = x + _shift(x, k, 0)
+        k *= 2
+    return x
@@ -0,0 +1,181 @@
+from functools import wraps
+import jax.numpy as np
+import numpy as onp
+from jax import random
+from jax.experimental.optimizers import JoinPoint, pack_optimizer_state, unpack_optimizer_state
+from jax.ops import index_update
+from jax.tree_util import tree_flatten, tree_leaves, tree_unflatten
+import numpyro
+import numpyro.distributions as dist
+from numpyro import handlers
+from numpyro.distributions import constraints
+from numpyro.distributions.transforms import biject_to
+from modules.covariates import take_items
+from modules.numpyro_models import start_index
+
+
+def item_batches(inputs, batch_size, shuffle=True, seed=0, start=0):
+    """
+    Yields minibatches of items, as the keywords `X`, `y`, `brk`, `size` and `items` of the
+    hierarchical models and of :class:`AutoItemNormal`, endlessly. Every epoch visits the items
+    in a new random order; the last incomplete batch of an epoch is dropped so that all batches
+    have the same shape and the SVI update is only compiled once.
+    The columns of the items in the batch are gathered at every step from `X` and `y`, which
+    are arrays in memory.
+    :param dict inputs: `X`, `y` with shape `T x n_items` and optionally `brk`.
+    :param int batch_size: number of items in every batch.
+    :param bool shuffle: draw the items in random order, otherwise in their order.
+    :param int seed: seed of the item order.
+    :param int start: number of batches to skip, without gathering them, e.g. to resume a run.
+    """
+    X, y = inputs['X'], inputs['y']
+    size = y.shape[-1]
+    batch_size = min(batch_size, size)
+    brk = onp.asarray(inputs['brk'] if inputs.get('brk') is not None else start_index(y))
+    rng = onp.random.RandomState(seed)
+    step = 0
+    while True:
+        order = rng.permutation(size) if shuffle else onp.arange(size)
+        for i in range(0, size - batch_size + 1, batch_size):
+            step += 1
+            if step <= start:
+                continue
+            # Sorted indices keep the items of the batch in their order in the data.
+            items = onp.sort(order[i:i + batch_size])
+            yield {'X': take_items(X, items),
+                   'y': np.asarray(y[:, items]),
+                   'brk': np.asarray(brk[items]),
+                   'size': size,
+                   'items': np.asarray(items)}
+
+
+def without_items(model):
+    """
+    Wraps a model so that it ignores the `items` keyword, only used by :class:`AutoItemNormal`.
+    """
+    @wraps(model)
+    def fn(*args, items=None, **kwargs):
+        return model(*args, **kwargs)
+
+    return fn
+
+
+class AutoItemNormal(object):
+    """
+    Mean-field normal guide, in the unconstrained space, for models whose `items` plate is
+    subsampled. Global latents have a single set of variational parameters. Latents in the
+    `items` plate have parameters for every item, of which only the columns of the minibatch,
+    given by the `items` keyword, are used: the local latents are re-optimised whenever their
+    item is drawn, and their log density is rescaled as the model's. The SVI update is
+    wrapped by :func:`batch_rows_update`, so that a step only changes the rows of the
+    minibatch in the local parameters and in their optimiser state.
+    Parameters are named `{prefix}_{site}_loc` and `{prefix}_{site}_scale`.
+
+    :param callable model: numpyro model, called with the keywords of :func:`item_batches`.
+    :param float init_scale: initial scale of the normal distributions.
+    :param str prefix: prefix of the parameter names.
+    """
+
+    def __init__(self, model, init_scale=0.1, prefix='auto'):
+        self.model = model
+        self.init_scale = init_scale
+        self.prefix = prefix
+        self.sites = None
+        self.size = None
+
+    def _setup(self, *args, **kwargs):
+        # A prior draw of the model on the first batch gives the shapes and supports of
+        # the latents; local ones start from their mean over the batch.
+        with handlers.block():
+            prototype_trace = handlers.trace(handlers.seed(self.model, random.PRNGKey(0))).get_trace(*args, **kwargs)
+        self.sites, self.size = {}, None
+        for name, site in prototype_trace.items():
+            if site['type'] != 'sample' or site['is_observed']:
+                continue
+            transform = biject_to(site['fn'].support)
+            value = transform.inv(site['value'])
+            # Draws outside of the declared support, e.g. of an affine map of a bounded
+            # domain, start from the origin of the unconstrained space.
+            value = np.where(np.isfinite(value), value, 0.)
+            frames = [f for f in site['cond_indep_stack'] if f.name == 'items']
+            axis = None
+            if frames:
+                axis = value.ndim + frames[0].dim - len(site['fn'].event_shape)
+                self.size = kwargs.get('size') or value.shape[axis]
+                shape = value.shape[:axis] + (self.size,) + value.shape[axis + 1:]
+                value = np.broadcast_to(np.mean(value, axis=axis, keepdims=True), shape)
+            self.sites[name] = (value, axis, transform)
+
+    def _posterior(self, name, params, items=None):
+        value, axis, transform = self.sites[name]
+        loc = params['{}_{}_loc'.format(self.prefix, name)]
+        scale = params['{}_{}_scale'.format(self.prefix, name)]
+        if axis is not None and items is not None:
+            loc, scale = np.take(loc, items, axis=axis), np.take(scale, items, axis=axis)
+        return loc, scale, axis, transform
+
+    def __call__(self, *args, items=None, **kwargs):
+        if self.sites is None:
+            self._setup(*args, **kwargs)
+        params = {}
+        for name, (value, _, _) in self.sites.items():
+            params['{}_{}_loc'.format(self.prefix, name)] = numpyro.param(
+                '{}_{}_loc'.format(self.prefix, name), value)
+            params['{}_{}_scale'.format(self.prefix, name)] = numpyro.param(
+                '{}_{}_scale'.format(self.prefix, name), np.full(np.shape(value), self.init_scale),
+                constraint=constraints.positive)
+        n_items = self.size if items is None else items.shape[0]
+        for name in self.sites:
+            loc, scale, axis, transform = self._posterior(name, params, items)
+            fn = dist.TransformedDistribution(dist.Normal(loc, scale), transform)
+            with handlers.scale(scale_factor=1. if axis is None else self.size / n_items):
+                numpyro.sample(name, fn)
+
+    def local_params(self):
+        """
+        Returns the names of the parameters of the local latents, with the position of
+        their `items` dimension and their number of dimensions.
+        """
+        return {'{}_{}_{}'.format(self.prefix, name, p): (axis, np.ndim(value))
+                for name, (value, axis, _) in self.sites.items() if axis is not None for p in ('loc', 'scale')}
+
+    def sample_posterior(self, rng_key, params, sample_shape=(), items=None):
+        """
+        Draws the latents from the guide.
+        :param rng_key: random number generator seed.
+        :param dict params: parameters returned by `SVI.get_params`.
+        :param tuple sample_shape: batch shape of the draws.
+        :param items: indices of the items to draw the local latents of, all items if None.
+        :return: dict of draws with shape `sample_shape + site shape`.
+        """
+        samples = {}
+        for name, rng_key in zip(self.sites, random.split(rng_key, len(self.sites))):
+            loc, scale, _, transform = self._posterior(name, params, items)
+            samples[name] = transform(loc + scale * random.normal(rng_key, sample_shape + loc.shape))
+        return samples
+
+
+def batch_rows_update(update, guide):
+    """
+    Wraps an SVI update with :class:`AutoItemNormal` so that only the rows of the items of
+    the minibatch change in the local parameters and in their optimiser state, as in a lazy
+    Adam. Other items have a zero gradient: a plain Adam step would still move them with the
+    momentum of their last batch and decay their moments, so they would drift between visits.
+    The rows of the items outside the minibatch are kept from before the step instead.
+    :param callable update: `update(state, step_size, **batch)`, see
+        :func:`modules.optimisation.scheduled_update`.
+    :param AutoItemNormal guide: guide of the SVI, after `SVI.init`.
+    """
+    def fn(state, step_size, *args, items, **kwargs):
+        new_state, loss = update(state, step_size, *args, items=items, **kwargs)
+        i, opt_state = new_state.optim_state
+        old, new = unpack_optimizer_state(state.optim_state[1]), unpack_optimizer_state(opt_state)
+        in_batch = index_update(np.zeros(guide.size, dtype=bool), items, True)
+        for name, (axis, ndim) in guide.local_params().items():
+            mask = np.reshape(in_batch, (1,) * axis + (guide.size,) + (1,) * (ndim - axis - 1))
+            leaves, tree = tree_flatten(new[name].subtree)
+            new[name] = JoinPoint(tree_unflatten(tree, [np.where(mask, x, x_old) for x, x_old in
+                                                        zip(leaves, tree_leaves(old[name].subtree))]))
+        return new_state._replace(optim_state=(i, pack_optimizer_state(new))), loss
+
+    return fn
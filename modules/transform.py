@@ -1,27 +1,87 @@
+import os
 import pandas as pd
 import jax.numpy as np
 import numpy as onp
+import scipy.fft as sp_fft
 import numpyro
 from functools import partial
 from itertools import product
 from datetime import datetime
-from sklearn.cluster import SpectralCoclustering
+from scipy import sparse
+from scipy.stats import rankdata
+from sklearn.cluster import SpectralClustering, SpectralCoclustering
+from sklearn.neighbors import NearestNeighbors
 from sklearn.metrics import consensus_score
+from modules.cache import ColumnarCache
+from modules.covariates import FactoredCovariates
+from modules.features import digest
+
+def convolve(x, kernel, method='auto', block_size=None):
+    """
+    Convolves every column of `x` with `kernel` along the time axis, with the
+    semantics of `numpy.convolve(x[:, i], kernel, mode='same')`, in one batched pass.
+    Columns are processed in contiguous blocks so that the working set stays small.
+    :param x: array with shape `T`, `T x n` or `T x n x m`.
+    :param kernel: 1-D convolution kernel.
+    :param str method: 'direct' accumulates one shifted copy of the block per kernel tap,
+        'fft' multiplies the spectra of the whole block, 'auto' picks 'direct' for short kernels.
+    :param int block_size: number of columns per block, chosen from the method if not given.
+    :return: array with shape `max(T, len(kernel)) x ...`, integer if both inputs are integer.
+    """
+    x = onp.asarray(x)
+    kernel = onp.asarray(kernel)
+    l, k = x.shape[0], kernel.shape[0]
+    dtype = onp.result_type(x.dtype, kernel.dtype)
+    if method == 'auto' or (method == 'direct' and k > l):
+        method = 'direct' if k <= min(l, 32) else 'fft'
+    if method not in ('direct', 'fft'):
+        raise ValueError("Unknown convolution method '{}'".format(method))
+    columns = x.reshape(l, -1)
+    out = onp.empty((max(l, k), columns.shape[1]), dtype=dtype)
+    start = (min(l, k) - 1) // 2
+    if method == 'direct':
+        block_size = block_size or max(1, 2 ** 15 // l)
+        for i in range(0, columns.shape[1], block_size):
+            out[:, i:i + block_size] = _direct_block(columns[:, i:i + block_size], kernel, start, dtype)
+    else:
+        block_size = block_size or 1024
+        n = sp_fft.next_fast_len(l + k - 1, real=True)
+        spectrum = sp_fft.rfft(kernel.astype(onp.float64), n)
+        for i in range(0, columns.shape[1], block_size):
+            block = onp.ascontiguousarray(columns[:, i:i + block_size].T, dtype=onp.float64)
+            full = sp_fft.irfft(sp_fft.rfft(block, n, axis=-1) * spectrum, n, axis=-1)
+            out[:, i:i + block_size] = _cast(full[:, start:start + out.shape[0]].T, dtype)
+    return out.reshape(out.shape[:1] + x.shape[1:])
+
+
+def _direct_block(x, kernel, start, dtype):
+    l = x.shape[0]
+    work_dtype = dtype if onp.issubdtype(dtype, onp.integer) else onp.float64
+    x = x.astype(work_dtype)
+    out = onp.zeros_like(x)
+    tmp = onp.empty_like(x)
+    for j, w in enumerate(kernel):
+        # out[t] += kernel[j] * x[t + start - j]
+        lo, hi = max(0, j - start), min(l, l + j - start)
+        if w != 0 and lo < hi:
+            onp.multiply(x[lo + start - j:hi + start - j], w, out=tmp[:hi - lo])
+            out[lo:hi] += tmp[:hi - lo]
+    return out
+
+
+def _cast(x, dtype):
+    return onp.rint(x) if onp.issubdtype(dtype, onp.integer) else x
+
+
+def _columns(x):
+    return x.reshape(-1, 1) if x.ndim <= 1 else x
+
 
 def expectation_convolution(x, steps, two_sided):
-    x_ = onp.array(x)
-    signal_ = onp.arange(steps)
+    signal = onp.arange(steps)
     if two_sided:
-        signal_inv = - onp.arange(steps)[::-1]
-        signal = np.append(signal_, signal_inv)
-    else:
-        signal = signal_
-    if len(x_.shape) <= 1:
-        computation = [onp.convolve(x_, signal, mode='same').reshape(-1, 1)]
-    else:
-        rng = x.shape[1]
-        computation = [onp.convolve(x_[:, i], signal, mode='same').reshape(-1, 1) for i in range(rng)]
-    return onp.concatenate(computation, axis=1)
+        signal = onp.append(signal, - onp.arange(steps)[::-1])
+    return _columns(convolve(x, signal))
 
 
 def log_normalise(x):
@@ -34,15 +94,9 @@ def log_normalise(x):
 
 
 def hump(x, n_days):
-    hump_signal = np.square(np.concatenate([np.arange(0, n_days), np.arange(0, n_days - 1)[::-1]]))
-    if len(x.shape) <= 1:
-        computation_ = [onp.convolve(x, hump_signal, mode='same').reshape(-1, 1)]
-    else:
-        rng = x.shape[1]
-        computation_ = [onp.convolve(x[:, i], hump_signal, mode='same').reshape(-1, 1) for i in range(rng)]
-    computation = onp.concatenate(computation_, axis=1)
-    rescaler = np.max(computation)
-    return 1 / rescaler * np.concatenate(computation_, axis=1)
+    hump_signal = onp.square(onp.concatenate([onp.arange(0, n_days), onp.arange(0, n_days - 1)[::-1]]))
+    computation = _columns(convolve(x, hump_signal.astype(onp.int32)))
+    return np.asarray(computation / np.max(computation))
 
 
 def transform(transformation_function, training_data, t_covariates, *args):
@@ -55,30 +109,146 @@ def transform(transformation_function, training_data, t_covariates, *args):
     return {name: _body_transform(name, value, t_covariates, *args)
             for name, value in training_data.items()}
 
-def cluster(y, X, n_clusters):
+def rank_scores(y, downsample=1):
+    """
+    Returns the rank-transformed series of `y` with shape `n_items x T'`, centred and
+    scaled to unit norm, so that the dot product of two rows is their Spearman
+    correlation. Constant series get zero scores.
+    :param y: sales with shape `T x n_items`.
+    :param int downsample: number of consecutive days summed into one step before
+        ranking, e.g. 7 for weekly series.
+    """
+    y = onp.asarray(y, dtype=onp.float64)
+    if downsample > 1:
+        l = y.shape[0] // downsample * downsample
+        y = y[y.shape[0] - l:].reshape((-1, downsample) + y.shape[1:]).sum(axis=1)
+    ranks = rankdata(y, axis=0)
+    ranks -= ranks.mean(axis=0)
+    norm = onp.sqrt(onp.square(ranks).sum(axis=0))
+    return (ranks / onp.where(norm > 0, norm, 1)).T
+
+
+def similarity_graph(scores, n_neighbors, n_jobs=-1):
+    """
+    Returns the sparse, symmetric `n_items x n_items` k-nearest-neighbour graph of the
+    rows of `scores`, weighted by `(1 + correlation) / 2`.
+    :param scores: unit-norm rank scores, see :func:`rank_scores`.
+    :param int n_neighbors: number of neighbours of each item.
+    :param int n_jobs: number of parallel jobs of the neighbour search, -1 for all cores.
+    """
+    n_neighbors = min(n_neighbors, scores.shape[0] - 1)
+    nn = NearestNeighbors(n_neighbors=n_neighbors, n_jobs=n_jobs).fit(scores)
+    graph = nn.kneighbors_graph(mode='distance')
+    # For unit-norm rows, ||a - b||^2 = 2 (1 - corr(a, b)).
+    graph.data = 1 - onp.square(graph.data) / 4
+    return graph.maximum(graph.T).tocsr()
+
+
+def cluster_items(y, n_clusters, method='kendall', n_neighbors=30, downsample=7, random_state=None, n_jobs=-1):
+    """
+    Returns the cluster label of every item.
+    :param y: sales with shape `T x n_items`.
+    :param int n_clusters: number of clusters.
+    :param str method: 'kendall' co-clusters the dense pandas Kendall matrix, 'spearman' the
+        dense rank correlation matrix computed by a single matmul, and 'knn' runs a sparse
+        spectral clustering on the nearest-neighbour graph of downsampled rank scores,
+        which scales to all series.
+    :param int n_neighbors: number of neighbours per item of the 'knn' graph.
+    :param int downsample: days summed per step before ranking for 'knn'.
+    :param int random_state: seed of the spectral clustering.
+    :param int n_jobs: number of parallel jobs of the nearest-neighbour search of 'knn', -1 for
+        all cores; the spectral clustering of the precomputed graph runs on a single job.
+    """
+    if method == 'kendall':
+        corr = pd.DataFrame(onp.array(y, dtype='float64')).corr(method='kendall')
+    elif method == 'spearman':
+        scores = rank_scores(y)
+        corr = scores @ scores.T
+    elif method == 'knn':
+        graph = similarity_graph(rank_scores(y, downsample), n_neighbors, n_jobs)
+        model = SpectralClustering(n_clusters=n_clusters, affinity='precomputed', eigen_solver='lobpcg',
+                                   assign_labels='discretize', random_state=random_state)
+        return model.fit(graph).labels_
+    else:
+        raise ValueError("Unknown clustering method '{}'".format(method))
+    model = SpectralCoclustering(n_clusters=n_clusters, random_state=random_state)
+    model.fit(corr)
+    return model.row_labels_
+
+
+def indicator(labels, n_clusters=None, dtype=onp.float64):
+    """
+    Returns the sparse `n_items x n_clusters` matrix whose entry `(i, c)` is 1 if item
+    `i` belongs to cluster `c`, so that `x @ S` sums the columns of `x` by cluster.
+    :param labels: cluster label in `0, ..., n_clusters - 1` of every item.
+    """
+    labels = onp.asarray(labels)
+    n_clusters = labels.max() + 1 if n_clusters is None else n_clusters
+    return sparse.csr_matrix((onp.ones(labels.size, dtype=dtype), (onp.arange(labels.size), labels)),
+                             shape=(labels.size, n_clusters))
+
+
+def segment_sum(x, S):
+    """
+    Sums the last axis of `x` by cluster with the indicator matrix `S`.
+    :param x: array with shape `... x n_items`.
+    :param S: indicator matrix, see :func:`indicator`.
+    :return: array with shape `... x n_clusters`.
+    """
+    x = onp.asarray(x)
+    flat = x.reshape(-1, x.shape[-1])
+    return onp.asarray((S.T @ flat.T).T).reshape(x.shape[:-1] + (S.shape[1],))
+
+
+def cluster_aggregate(y, X, labels):
+    """
+    Aggregates sales and item-specific covariates by cluster in one pass of sparse
+    indicator products, whatever the number of clusters.
+    :param y: sales with shape `T x n_items`.
+    :param X: item-specific covariates with shape `T x n_cov x n_items`.
+    :param labels: cluster label in `0, ..., n_clusters - 1` of every item.
+    :return: the cluster totals of `y` with shape `T x n_clusters`, the market share of
+        every item within its cluster, and the covariates averaged by cluster with the
+        market shares as weights, with shape `T x n_cov x n_clusters`.
+    """
+    y = onp.asarray(y)
+    S = indicator(labels)
+    y_ = segment_sum(y, S.astype(onp.result_type(y.dtype, onp.int64)))
+    item_totals = y.sum(axis=0, dtype=onp.float64)
+    shares = item_totals / segment_sum(item_totals, S)[labels]
+    X = onp.asarray(X)
+    # Weights are accumulated in float64, the averages keep the precision of the covariates.
+    X_ = segment_sum(X * shares, S) / segment_sum(shares, S)
+    return y_, shares, X_.astype(onp.result_type(X.dtype, onp.float32))
+
+
+def cluster(y, X, n_clusters, cache=None, **kwargs):
+    """
+    Clusters the items by the correlation of their sales and aggregates sales and
+    item-specific covariates by cluster.
+    :param y: sales with shape `T x n_items`.
+    :param X: covariates with shape `T x n_cov x n_items`, or :class:`FactoredCovariates`.
+    :param int n_clusters: number of clusters.
+    :param str cache: folder where the cluster labels are cached, keyed on `y` and the
+        clustering parameters, so that later runs reuse them.
+    :param kwargs: parameters of :func:`cluster_items`.
+    """
+    if isinstance(X, FactoredCovariates):
+        # Common covariates are identical across items, only item-specific ones are aggregated.
+        y_, X_individual, clusters = cluster(y, X.individual, n_clusters, cache, **kwargs)
+        return y_, FactoredCovariates(X.common, X_individual, X.categorical, X.categorical_dims), clusters
     if n_clusters != 1 :
-        y_ = onp.array(y,dtype='float64')
-        # mask = onp.clip((onp.diff(y, n=1, axis=0) == 0).argmin(axis=0),a_max=2 * (y.shape[0] // 3),a_min=0)
-        # for i in range(mask.size):
-        #     y_[range(mask[i]),i] = np.nan
-        corr = pd.DataFrame(y_).corr(method='kendall')
-        model = SpectralCoclustering(n_clusters=n_clusters)
-        model.fit(corr)
-        clusters = [model.get_indices(i)[0] for i in range(n_clusters)]
-        def fn_by_cluster(x,fn,weights=None):
-            if weights is not None:
-                return np.concatenate([fn(x[..., rng], axis=-1, weights=weights[i])[..., np.newaxis]
-                                       for i, rng in enumerate(clusters)], axis=-1)
-            else:
-                return np.concatenate([fn(x[..., rng], axis=-1)[..., np.newaxis]
-                                       for i, rng in enumerate(clusters)],axis=-1)
-
-        fn_market_share = lambda x: [np.sum(x[...,rng],axis=0)/np.sum(x[...,rng]) for rng in clusters]
-
-        y_ = fn_by_cluster(y,np.sum)
-        #Compute within-group market shares
-        y_weights = fn_market_share(y)
-        X_ = fn_by_cluster(X,np.average,y_weights)
-        return y_, X_, clusters
+        if cache is None:
+            labels = cluster_items(y, n_clusters, **kwargs)
+        else:
+            key = digest(y, n_clusters, kwargs)
+            labels_cache = ColumnarCache(os.path.join(cache, key), key=key)
+            if not labels_cache.is_valid():
+                labels_cache.save({"labels": cluster_items(y, n_clusters, **kwargs)})
+            labels = labels_cache.load("labels", mmap_mode=None)
+        _, labels = onp.unique(labels, return_inverse=True)
+        y_, _, X_ = cluster_aggregate(y, X, labels)
+        clusters = [onp.flatnonzero(labels == i) for i in range(y_.shape[-1])]
+        return np.asarray(y_), np.asarray(X_), clusters
     else:
         return np.sum(y,axis=-1)[...,np.newaxis],np.mean(X,axis=-1)[...,np.newaxis],1
\ No newline at end of file
@@ -7,20 +7,77 @@ import zipfile
 import dask.dataframe as dd
 import numpy as np
 import pandas as pd
+from scipy import sparse
 from datetime import datetime
-import pickle
+from functools import partial
+from modules.cache import ColumnarCache, source_key, dump_frame, write_frame, load_frame, load_column, memo
+from modules.features import FeatureStore
 
 def trend(s_datetime):
     return  np.linspace(start=-1, stop=1, num=s_datetime.shape[0])
 
-def pickle_path(name):
-    return r'data/{}.pkl'.format(name)
+def backfill(x):
+    """
+    Fills NaN values along the last axis with the next valid value, as
+    `pandas.DataFrame.fillna(axis=1, method='backfill')` does.
+    :param np.array x: array of shape `num_series x num_steps`.
+    """
+    n = x.shape[-1]
+    steps = np.where(np.isnan(x), n, np.arange(n))
+    steps = np.minimum.accumulate(steps[..., ::-1], axis=-1)[..., ::-1]
+    padded = np.concatenate([x, np.full(x.shape[:-1] + (1,), np.nan, dtype=x.dtype)], axis=-1)
+    return np.take_along_axis(padded, steps, axis=-1)
 
-def load_pickle(name):
-    return pickle.load(open(pickle_path(name), "rb"))
+class DailyPrices:
+    """
+    Read-only `num_days x num_items` view of a `num_items x num_weeks` prices matrix.
+    Days are mapped to weeks through an index, so the daily matrix is never
+    materialized: indexing only gathers the selected days and items.
 
-def dump_pickle(data,name):
-    pickle.dump(data[name], open(pickle_path(name), "wb"))
+    :param np.array weekly: prices with shape `num_items x num_weeks`.
+    :param np.array day_to_week: week position of every day.
+    """
+    def __init__(self, weekly, day_to_week):
+        self.weekly = weekly
+        self.day_to_week = day_to_week
+
+    @property
+    def shape(self):
+        return (self.day_to_week.shape[0], self.weekly.shape[0])
+
+    @property
+    def ndim(self):
+        return 2
+
+    @property
+    def dtype(self):
+        return self.weekly.dtype
+
+    def __getitem__(self, key):
+        days, items = key if isinstance(key, tuple) else (key, slice(None))
+        x = np.asarray(self.weekly[items])[..., self.day_to_week[days]]
+        return x.T if x.ndim == 2 else x
+
+    def __array__(self, dtype=None):
+        x = self[:, :]
+        return x if dtype is None else x.astype(dtype)
+
+def rolling_mean(x, window):
+    """
+    Trailing moving average along the last axis, ignoring NaN values and averaging
+    over the available values for the first `window - 1` steps, as
+    `pandas.DataFrame.rolling(window, min_periods=1).mean()` does.
+    The result is NaN where the window only contains NaN values.
+    :param np.array x: array of shape `num_series x num_steps`.
+    :param int window: size of the moving window.
+    """
+    valid = ~np.isnan(x)
+    total = np.cumsum(np.where(valid, x, 0), axis=-1, dtype=np.float64)
+    count = np.cumsum(valid, axis=-1, dtype=np.int32)
+    total[..., window:] = total[..., window:] - total[..., :-window]
+    count[..., window:] = count[..., window:] - count[..., :-window]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return total / count
 
 
 class M5Data:
@@ -34,6 +91,10 @@ class M5Data:
 
     states = {"CA":0, "TX":1, "WI":2}
 
+    chunk_size = 2048
+
+    price_chunk_size = 1000000
+
     def __init__(self, data_path=None):
         self.data_path = os.path.abspath("../data") if data_path is None else data_path
         if not os.path.exists(self.data_path):
@@ -43,14 +104,12 @@ class M5Data:
         unc_path = os.path.join(self.data_path, "m5-forecasting-uncertainty.zip")
         self.acc_zipfile = zipfile.ZipFile(acc_path) if os.path.exists(acc_path) else None
         self.unc_zipfile = zipfile.ZipFile(unc_path) if os.path.exists(unc_path) else None
-        self.data_dict = {}
-        self.data_dict['_sales_df'] = None
-        self.data_dict['_calendar_df'] = None
-        self.data_dict['_prices_df'] = None
+        self.cache_path = os.path.join(self.data_path, "_cache")
+        self._caches = {}
 
     @property
     def num_items(self):
-        return self.sales_df.shape[0]
+        return self._load(self.sales_cache, "values").shape[0]
 
     @property
     def num_aggregations(self):
@@ -58,64 +117,167 @@ class M5Data:
 
     @property
     def num_days(self):
-        return self.sales_df.shape[1] - 5 + 2 * 28
+        return self._load(self.sales_cache, "values").shape[1] + 2 * 28
 
     @property
     def num_items_by_state(self):
-        return self.sales_df["state_id"].value_counts().to_dict()
+        return pd.Series(self.list_states).value_counts().to_dict()
 
     @property
     def list_states(self):
-        return self.sales_df["state_id"].values
+        cache = self.sales_cache
+        return memo.get(cache, "state_id", lambda: load_column(cache, "state_id"))
 
     @property
     def event_types(self):
         return ["Cultural", "National", "Religious", "Sporting"]
 
+    @property
+    def sales_cache(self):
+        """
+        Columnar cache of `sales_train_validation.csv`: the id columns and a
+        memory-mapped `num_items x num_train_days` sales matrix.
+        """
+        cache = self._cache("sales", "sales_train_validation.csv")
+        if not cache.is_valid():
+            self._ingest_sales(cache)
+        return cache
+
+    def _ingest_sales(self, cache):
+        """
+        Streams `sales_train_validation.csv` into ``cache`` by blocks of `chunk_size`
+        rows. Sales are downcast to int16 and written straight into a memory-mapped
+        matrix, and the id columns are stored as categoricals, so peak memory is
+        proportional to the block size rather than to the file size.
+        """
+        filename = "sales_train_validation.csv"
+        columns = self._read_csv(filename, index_col=0, nrows=0).columns
+        id_columns, days = list(columns[:5]), list(columns[5:])
+        num_rows = self._count_rows(filename)
+        cache.begin()
+        values = cache.open_column("values", shape=(num_rows, len(days)), dtype=np.int16)
+        ids, start = [], 0
+        dtype = {**{c: str for c in id_columns}, **{d: np.int16 for d in days}}
+        for chunk in self._iter_csv(filename, self.chunk_size, index_col=0, dtype=dtype):
+            values[start:start + chunk.shape[0]] = chunk[days].values
+            ids.append(chunk[id_columns])
+            start += chunk.shape[0]
+        assert start == num_rows
+        values.flush()
+        del values
+        ids = pd.concat(ids).astype("category")
+        attrs = write_frame(cache, ids)
+        attrs["order"] += days
+        attrs["block"] = days
+        cache.commit(attrs)
+
+    @property
+    def calendar_cache(self):
+        """
+        Columnar cache of `calendar.csv`.
+        """
+        cache = self._cache("calendar", "calendar.csv")
+        if not cache.is_valid():
+            df = self._read_csv("calendar.csv", index_col=0)
+            df.index = pd.to_datetime(df.index)
+            dump_frame(cache, df)
+        return cache
+
+    @property
+    def prices_cache(self):
+        """
+        Columnar cache of the `num_items x num_weeks` prices matrix, with rows
+        ordered as in `sales_df`.
+        """
+        cache = self._cache("prices", "sell_prices.csv", "sales_train_validation.csv", "calendar.csv")
+        if not cache.is_valid():
+            item_codes, items = self._id_codes("item_id")
+            store_codes, stores = self._id_codes("store_id")
+            items, stores = pd.Index(items), pd.Index(stores)
+            # Row of `sales_df` of every (item, store) pair, -1 if the pair is not sold.
+            lookup = np.full((len(items), len(stores)), -1, dtype=np.int64)
+            lookup[item_codes, store_codes] = np.arange(item_codes.shape[0])
+            weeks = np.unique(load_column(self.calendar_cache, "wm_yr_wk"))
+            prices = np.full((item_codes.shape[0], weeks.shape[0]), np.nan, dtype=np.float32)
+            dtype = {"store_id": str, "item_id": str, "wm_yr_wk": np.int32, "sell_price": np.float32}
+            for chunk in self._iter_csv("sell_prices.csv", self.price_chunk_size, dtype=dtype):
+                item = items.get_indexer(chunk["item_id"])
+                store = stores.get_indexer(chunk["store_id"])
+                week = np.minimum(np.searchsorted(weeks, chunk["wm_yr_wk"].values), weeks.shape[0] - 1)
+                rows = np.where((item >= 0) & (store >= 0), lookup[item, store], -1)
+                known = (rows >= 0) & (weeks[week] == chunk["wm_yr_wk"].values)
+                prices[rows[known], week[known]] = chunk["sell_price"].values[known]
+            df = pd.DataFrame(backfill(prices), index=load_column(self.sales_cache, "__index__"), columns=weeks)
+            dump_frame(cache, df, block=df.columns)
+        return cache
+
     @property
     def sales_df(self):
-        name_df = '_sales_df'
-        if self.data_dict[name_df] is None:
-            if os.path.exists(pickle_path(name_df)):
-                return load_pickle(name_df)
-            else:
-                self.data_dict[name_df] = self._read_csv("sales_train_validation.csv", index_col=0)
-                dump_pickle(self.data_dict,name_df)
-            return self.data_dict[name_df]
-        else:
-            return self.data_dict[name_df]
+        cache = self.sales_cache
+        return memo.get(cache, "frame", lambda: load_frame(cache))
 
     @property
     def calendar_df(self):
-        name_df = '_calendar_df'
-        if self.data_dict[name_df] is None:
-            if os.path.exists(pickle_path(name_df)):
-                return load_pickle(name_df)
-            else:
-                self.data_dict[name_df] = self._read_csv("calendar.csv", index_col=0)
-                self.data_dict[name_df].index = pd.to_datetime(self.data_dict[name_df].index)
-                dump_pickle(self.data_dict,name_df)
-                return self.data_dict[name_df]
-        else:
-            return self.data_dict[name_df]
-
+        cache = self.calendar_cache
+        return memo.get(cache, "frame", lambda: load_frame(cache))
 
     @property
     def prices_df(self):
-        name_df = '_prices_df'
-        if self.data_dict[name_df] is None:
-            if os.path.exists(pickle_path(name_df)):
-                return load_pickle(name_df)
-            else:
-                df = self._read_csv("sell_prices.csv")
-                df = df.assign(id = lambda x: x.item_id + "_" + x.store_id + "_validation")
-                df = pd.pivot_table(df, values="sell_price", index="id", columns="wm_yr_wk")
-                df = df.fillna(axis=1, method='backfill')
-                self.data_dict[name_df] = df.loc[self.sales_df.index]
-                dump_pickle(self.data_dict,name_df)
-                return self.data_dict[name_df]
-        else:
-            return self.data_dict[name_df]
+        cache = self.prices_cache
+        return memo.get(cache, "frame", lambda: load_frame(cache))
+
+    @property
+    def features(self):
+        """
+        Returns the :class:`FeatureStore` of cached calendar covariates.
+        """
+        return FeatureStore(self)
+
+    def invalidate(self, disk=False):
+        """
+        Drops the frames and arrays memoized for this data folder.
+        :param bool disk: whether to also remove the on-disk caches, forcing them
+            to be rebuilt from the source files.
+        """
+        memo.invalidate(self.cache_path)
+        if disk:
+            for cache in self._caches.values():
+                cache.invalidate()
+        self._caches = {}
+
+    def _source_path(self, filename, use_acc_file=True):
+        """
+        Returns the path of the file (zip archive or extracted csv) ``filename`` is read from.
+        """
+        if use_acc_file and self.acc_zipfile and filename in self.acc_zipfile.namelist():
+            return self.acc_zipfile.filename
+        if self.unc_zipfile and filename in self.unc_zipfile.namelist():
+            return self.unc_zipfile.filename
+        return os.path.join(self.data_path, filename)
+
+    def signature(self, *filenames):
+        """
+        Returns the size and mtime of the sources of ``filenames``, all source files if
+        none is given, to key data derived from them.
+        """
+        filenames = filenames or ("sales_train_validation.csv", "calendar.csv", "sell_prices.csv")
+        return [source_key(self._source_path(f)) for f in filenames]
+
+    def _cache(self, name, *filenames):
+        """
+        Returns the :class:`ColumnarCache` ``name`` keyed on the size and mtime of
+        the sources of ``filenames``, so that it is rebuilt when a source changes.
+        """
+        key = self.signature(*filenames)
+        if name not in self._caches or self._caches[name].key != key:
+            self._caches[name] = ColumnarCache(os.path.join(self.cache_path, name), key=key)
+        return self._caches[name]
+
+    def _load(self, cache, name):
+        """
+        Returns the memory-mapped column ``name`` of ``cache``, memoized for the process.
+        """
+        return memo.get(cache, name, lambda: cache.load(name))
 
     def listdir(self):
         """
@@ -128,12 +290,11 @@ class M5Data:
             files |= set(self.unc_zipfile.namelist())
         return files
 
-    def _read_csv(self, filename, index_col=None, use_acc_file=True):
+    def _open(self, filename, use_acc_file=True):
         """
-        Returns the dataframe from csv file ``filename``.
+        Returns a binary file object streaming the csv file ``filename``.
         :param str filename: name of the file with trailing `.csv`.
-        :param int index_col: indicates which column from csv file is considered as index.
-        :param bool acc_file: whether to load data from accuracy.zip file or uncertainty.zip file.
+        :param bool use_acc_file: whether to load data from accuracy.zip file or uncertainty.zip file.
         """
         assert filename.endswith(".csv")
         if filename not in self.listdir():
@@ -142,29 +303,106 @@ class M5Data:
                                     f"in '{self.data_path}'.")
 
         if use_acc_file and self.acc_zipfile and filename in self.acc_zipfile.namelist():
-            return pd.read_csv(self.acc_zipfile.open(filename), index_col=index_col)
+            return self.acc_zipfile.open(filename)
 
         if self.unc_zipfile and filename in self.unc_zipfile.namelist():
-            return pd.read_csv(self.acc_zipfile.open(filename), index_col=index_col)
+            return self.unc_zipfile.open(filename)
+
+        return open(os.path.join(self.data_path, filename), "rb")
 
-        return pd.read_csv(os.path.join(self.data_path, filename), index_col=index_col)
+    def _read_csv(self, filename, index_col=None, use_acc_file=True, **kwargs):
+        """
+        Returns the dataframe from csv file ``filename``.
+        :param str filename: name of the file with trailing `.csv`.
+        :param int index_col: indicates which column from csv file is considered as index.
+        :param bool use_acc_file: whether to load data from accuracy.zip file or uncertainty.zip file.
+        :param kwargs: other arguments passed to `pd.read_csv`.
+        """
+        with self._open(filename, use_acc_file) as f:
+            return pd.read_csv(f, index_col=index_col, **kwargs)
 
-    def get_sales(self):
+    def _iter_csv(self, filename, chunksize, index_col=None, use_acc_file=True, **kwargs):
+        """
+        Yields the csv file ``filename`` as dataframes of ``chunksize`` rows.
+        """
+        with self._open(filename, use_acc_file) as f:
+            for chunk in pd.read_csv(f, index_col=index_col, chunksize=chunksize, **kwargs):
+                yield chunk
+
+    def _count_rows(self, filename, use_acc_file=True):
+        """
+        Returns the number of data rows of the csv file ``filename``, streaming it by blocks.
+        """
+        count, last = 0, b"\n"
+        with self._open(filename, use_acc_file) as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                count += block.count(b"\n")
+                last = block[-1:]
+        return count - 1 + (last != b"\n")
+
+    def _id_codes(self, column):
+        """
+        Returns the integer codes and the categories of the id column ``column``.
+        """
+        cache = self.sales_cache
+        return memo.get(cache, "{}.codes".format(column),
+                        lambda: (cache.load("{}.codes".format(column), mmap_mode=None),
+                                 cache.load("{}.categories".format(column), mmap_mode=None)))
+
+    def select_items(self, rows=None, ids=None, items=None, stores=None, depts=None, cats=None, states=None):
+        """
+        Returns the positions of the series matching all the given filters, without
+        reading any sales. Filters left to `None` are ignored.
+        :param rows: positional indices (list, range or slice) of the series.
+        :param list ids: series ids, e.g. `HOBBIES_1_001_CA_1_validation`.
+        :param list items: item ids, e.g. `HOBBIES_1_001`.
+        :param list stores: store ids, e.g. `CA_1`.
+        :param list depts: department ids, e.g. `HOBBIES_1`.
+        :param list cats: category ids, e.g. `HOBBIES`.
+        :param list states: state ids, e.g. `CA`.
+        """
+        positions = np.arange(self.num_items)
+        if rows is not None:
+            positions = positions[rows] if isinstance(rows, slice) else positions[np.asarray(rows)]
+        filters = [("__index__", ids), ("item_id", items), ("store_id", stores),
+                   ("dept_id", depts), ("cat_id", cats), ("state_id", states)]
+        for column, values in filters:
+            if values is None:
+                continue
+            codes, categories = self._id_codes(column)
+            wanted = np.flatnonzero(np.isin(categories, np.atleast_1d(values)))
+            positions = positions[np.isin(codes[positions], wanted)]
+        return positions
+
+    def get_sales(self, rows=None):
         """
         Returns `sales` np.array with shape `num_items x num_train_days`.
+        :param rows: positions of the series to read (see :meth:`select_items`).
+            Only those rows of the memory-mapped sales matrix are read. Defaults to all.
+        """
+        x = self._load(self.sales_cache, "values")
+        return x if rows is None else x[rows]
+
+    @property
+    def day_to_week(self):
+        """
+        Returns the position in the prices matrix of the week of every day.
         """
-        return self.sales_df.iloc[:, 5:].values
+        prices_cache, calendar_cache = self.prices_cache, self.calendar_cache
+        weeks = np.asarray(prices_cache.attrs["block"])
+        return memo.get(calendar_cache, "day_to_week",
+                        lambda: np.searchsorted(weeks, load_column(calendar_cache, "wm_yr_wk")))
 
-    def get_prices(self):
+    def get_prices(self, rows=None):
         """
-        Returns `prices` np.array with shape `num_items x num_days`.
+        Returns `prices` as a lazy :class:`DailyPrices` view with shape `num_days x num_items`.
         In some days, there are some items not available, so their prices will be NaN.
-        :param float fillna: a float value to replace NaN. Defaults to 0.
+        :param rows: positions of the series to read (see :meth:`select_items`). Defaults to all.
         """
-        x = self.prices_df.values
-        x = np.repeat(x,repeats=7,axis=-1)[:, :self.calendar_df.shape[0]]
-        assert x.shape == (self.num_items, self.num_days)
-        return x.T
+        x = self._load(self.prices_cache, "values")
+        x = DailyPrices(x if rows is None else x[rows], self.day_to_week)
+        assert x.shape[0] == self.num_days
+        return x
 
     def get_snap(self):
         """
@@ -263,10 +501,11 @@ class M5Data:
         assert x.shape == (self.num_days, 1)
         return x
 
-    def get_aggregated_sales(self, state=True, store=True, cat=True, dept=True, item=True):
+    def _group_rows(self, state=True, store=True, cat=True, dept=True, item=True):
         """
-        Returns aggregated sales at a particular aggregation level.
-        The result will be a tensor with shape `num_timeseries x num_train_days`.
+        Returns, for each series, the index of the aggregated series it belongs to at a
+        particular aggregation level. Aggregated series are ordered by first appearance,
+        as in `groupby(..., sort=False)`.
         """
         groups = []
         if not state:
@@ -280,11 +519,106 @@ class M5Data:
         if not item:
             groups.append("item_id")
 
-        if len(groups) > 0:
-            x = self.sales_df.groupby(groups, sort=False).sum().values
-        else:
-            x = self.sales_df.iloc[:, 5:].sum().values[None, :]
-        return x
+        if len(groups) == 0:
+            return np.zeros(self.num_items, dtype=np.int32)
+        keys = np.stack([self._id_codes(g)[0] for g in groups], axis=1)
+        _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+        rank = np.empty(first.shape[0], dtype=np.int32)
+        rank[np.argsort(first)] = np.arange(first.shape[0])
+        return rank[inverse.reshape(-1)]
+
+    @property
+    def summing_cache(self):
+        """
+        Columnar cache of the `num_levels x num_items` matrix giving the row of the
+        summing matrix each series is added to at every aggregation level.
+        """
+        cache = self._cache("summing", "sales_train_validation.csv")
+        if not cache.is_valid():
+            rows, offset = [], 0
+            for level in self.aggregation_levels:
+                x = self._group_rows(**level)
+                rows.append(x + offset)
+                offset += x.max() + 1
+            cache.save({"rows": np.stack(rows, axis=0)})
+        return cache
+
+    def _build_summing_matrix(self, rows, num_rows):
+        num_levels, num_items = rows.shape
+        data = np.ones(num_levels * num_items, dtype=np.int8)
+        cols = np.tile(np.arange(num_items), num_levels)
+        return sparse.csr_matrix((data, (rows.reshape(-1), cols)), shape=(num_rows, num_items))
+
+    def summing_matrix(self, level=None):
+        """
+        Returns the sparse summing matrix `S` with shape `num_aggregations x num_items`,
+        so that `S @ x` gives all aggregated series of the bottom-level series `x` in
+        the order of `self.aggregation_levels`. It is built once from the id columns.
+        :param dict level: if given, only returns the rows of this aggregation level.
+        """
+        if level is not None:
+            rows = self._group_rows(**level)
+            return self._build_summing_matrix(rows[None, :], rows.max() + 1)
+        cache = self.summing_cache
+        def build():
+            rows = cache.load("rows", mmap_mode=None)
+            return self._build_summing_matrix(rows, rows.max() + 1)
+        return memo.get(cache, "matrix", build)
+
+    def aggregate(self, x, level=None, axis=0):
+        """
+        Aggregates bottom-level series with the summing matrix in a single sparse matmul.
+        Works on history as well as on forecast samples.
+        :param np.array x: array whose `axis` dimension has size `num_items`.
+        :param dict level: aggregation level, defaults to all levels.
+        :param int axis: dimension of `x` indexing the series.
+        :return: array with the `axis` dimension replaced by the aggregated series,
+            `num_aggregations` of them if `level` is `None`.
+        """
+        x = np.moveaxis(np.asarray(x), axis, 0)
+        dtype = np.int64 if np.issubdtype(x.dtype, np.integer) else x.dtype
+        S = self.summing_matrix(level).astype(dtype)
+        result = S @ x.reshape(x.shape[0], -1)
+        return np.moveaxis(result.reshape((-1,) + x.shape[1:]), 0, axis)
+
+    def get_aggregated_sales(self, state=True, store=True, cat=True, dept=True, item=True):
+        """
+        Returns aggregated sales at a particular aggregation level.
+        The result will be a tensor with shape `num_timeseries x num_train_days`.
+        """
+        level = {"state": state, "store": store, "cat": cat, "dept": dept, "item": item}
+        return self.aggregate(self.get_sales(), level=level)
+
+    @property
+    def ma_dollar_sales_cache(self):
+        """
+        Columnar cache of the bottom-level 28-day moving average dollar sales, a
+        float32 `num_items x num_train_days` matrix. It is computed block by block
+        of `chunk_size` series, so memory stays bounded on the full dataset.
+        """
+        cache = self._cache("ma_dollar_sales", "sales_train_validation.csv", "sell_prices.csv", "calendar.csv")
+        if not cache.is_valid():
+            sales = self.get_sales()
+            prices = self._load(self.prices_cache, "values")
+            days = self.day_to_week[:sales.shape[1]]
+            cache.begin()
+            out = cache.open_column("values", shape=sales.shape, dtype=np.float32)
+            for start in range(0, sales.shape[0], self.chunk_size):
+                rows = slice(start, start + self.chunk_size)
+                dollar = sales[rows].astype(np.float32)
+                dollar *= prices[rows][:, days]
+                out[rows] = np.nan_to_num(rolling_mean(dollar, 28))
+            out.flush()
+            del out
+            cache.commit()
+        return cache
+
+    def _ma_dollar_sales(self):
+        """
+        Returns the bottom-level "moving average" dollar sales during the last 28 days,
+        with shape `num_items x num_train_days`. Missing values are set to 0.
+        """
+        return self._load(self.ma_dollar_sales_cache, "values")
 
     def get_aggregated_ma_dollar_sales(self, state=True, store=True,
                                        cat=True, dept=True, item=True):
@@ -293,37 +627,14 @@ class M5Data:
         during the last 28 days.
         The result can be used as `weight` for evaluation metrics.
         """
-        groups = []
-        if not state:
-            groups.append("state_id")
-        if not store:
-            groups.append("store_id")
-        if not cat:
-            groups.append("cat_id")
-        if not dept:
-            groups.append("dept_id")
-        if not item:
-            groups.append("item_id")
-
-        prices = self.prices_df.values.repeat(7, axis=1)[:, :self.sales_df.shape[1] - 5]
-        df = (self.sales_df.iloc[:, 5:] * prices).T.rolling(28, min_periods=1).mean().T
-
-        if len(groups) > 0:
-            for g in groups:
-                df[g] = self.sales_df[g]
-            x = df.groupby(groups, sort=False).sum().values
-        else:
-            x = df.sum().values[None, :]
-        return x
+        level = {"state": state, "store": store, "cat": cat, "dept": dept, "item": item}
+        return self.aggregate(self._ma_dollar_sales(), level=level)
 
     def get_all_aggregated_sales(self):
         """
         Returns aggregated sales for all aggregation levels.
         """
-        xs = []
-        for level in self.aggregation_levels:
-            xs.append(self.get_aggregated_sales(**level))
-        xs = np.concatenate(xs,axis=0)
+        xs = self.aggregate(self.get_sales())
         assert xs.shape[0] == self.num_aggregations
         return xs
 
@@ -331,10 +642,7 @@ class M5Data:
         """
         Returns aggregated "moving average" dollar sales for all aggregation levels.
         """
-        xs = []
-        for level in self.aggregation_levels:
-            xs.append(self.get_aggregated_ma_dollar_sales(**level))
-        xs = np.concatenate(xs,axis=0)
+        xs = self.aggregate(self._ma_dollar_sales())
         assert xs.shape[0] == self.num_aggregations
         return xs
 
@@ -392,17 +700,22 @@ class M5Data:
         df.iloc[:prediction.shape[0], :] = prediction
         df.to_csv(filename)
 
-def load_training_data(items, covariates=None):
+def load_training_data(items=None, covariates=None, **selection):
     """
-    Load sales for first item and covariates.
-    :return:
+    Load sales and covariates for a selection of series. Only the selected rows of
+    the cached sales and prices matrices are read.
+    :param items: positional indices (list, range or slice) of the series.
+    :param list covariates: names of the covariates to load.
+    :param selection: other filters of :meth:`M5Data.select_items`, e.g. `depts=['FOODS_1']`.
+    :return: calendar and dict of training data.
     """
     if covariates is None:
         covariates = ['month']
     data_path = r"data/"
     m5 = M5Data(data_path)
-    sales = m5.get_sales()[items]
-    col_snap = [m5.states[x] for x in m5.list_states[items]]
+    rows = m5.select_items(rows=items, **selection)
+    sales = m5.get_sales(rows)
+    col_snap = [m5.states[x] for x in m5.list_states[rows]]
     calendar = m5.calendar_df.index.values[:sales.shape[-1]]
     variables_set = ['price',
                      'christmas',
@@ -413,15 +726,16 @@ def load_training_data(items, covariates=None):
                      'event',
                      'trend',
                      'thanksgiving']
-    functions = [m5.get_prices,
-                 m5.get_christmas,
-                 m5.get_dummy_day_of_week,
-                 m5.get_dummy_day_of_month,
-                 m5.get_dummy_month_of_year,
-                 m5.get_snap,
-                 m5.get_event,
-                 m5.get_trend,
-                 m5.get_thanksgiving]
+    features = m5.features
+    functions = [lambda: m5.get_prices(rows),
+                 partial(features.get, 'christmas'),
+                 partial(features.get, 'dayofweek'),
+                 partial(features.get, 'dayofmonth'),
+                 partial(features.get, 'month'),
+                 partial(features.get, 'snap'),
+                 partial(features.get, 'event'),
+                 partial(features.get, 'trend'),
+                 partial(features.get, 'thanksgiving')]
     _ = dict(zip(variables_set, functions))
     selected_variables = {k: _[k] for k in covariates}
     data = [f() for f in list(selected_variables.values())]
@@ -430,8 +744,6 @@ def load_training_data(items, covariates=None):
     training_data['sales'] = sales.T
     if 'snap' in covariates:
         training_data['snap'] = training_data['snap'][:, col_snap]
-    if 'price' in covariates:
-        training_data['price'] = training_data['price'][:, items]
     return calendar, training_data
 
 
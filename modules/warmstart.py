@@ -0,0 +1,98 @@
+import logging
+import jax.numpy as np
+import numpy as onp
+from jax import random, vmap
+from numpyro import handlers
+from numpyro.infer import NUTS
+from numpyro.infer.hmc_util import dual_averaging
+from modules.cache import ColumnarCache
+from modules.checkpoint import model_key
+from modules.features import digest
+
+logger = logging.getLogger()
+
+
+def adaptation_key(model, inputs, num_chains):
+    """
+    Returns the key of the NUTS adaptation of `model`. It changes with the code and the
+    configuration of the model (see :func:`modules.checkpoint.model_key`), the names, shapes
+    and dtypes of its latent variables and the number of chains, but not with the data
+    otherwise: a refit on one more day reuses the adaptation of the previous one, unless a
+    latent variable grows with the days.
+    :param model: numpyro model, e.g. the `model` method of a :class:`modules.numpyro_models.Model`.
+    :param dict inputs: keyword arguments of the model.
+    :param int num_chains: number of chains.
+    """
+    trace = handlers.trace(handlers.seed(model, random.PRNGKey(0))).get_trace(**inputs)
+    latent = [[name, site['value'].shape, str(site['value'].dtype)] for name, site in trace.items()
+              if site['type'] == 'sample' and not site['is_observed']]
+    return digest(model_key(model), latent, num_chains)
+
+
+def save_adaptation(path, key, state):
+    """
+    Saves the unconstrained position, step size and inverse mass matrix of the last state of
+    a NUTS run, with a leading chain dimension when there are several chains.
+    :param str path: folder of the adaptation.
+    :param str key: key returned by :func:`adaptation_key`.
+    :param state: last `HMCState` of the run.
+    """
+    columns = {'z_{}'.format(name): onp.asarray(value) for name, value in state.z.items()}
+    columns['step_size'] = onp.asarray(state.adapt_state.step_size)
+    columns['inverse_mass_matrix'] = onp.asarray(state.adapt_state.inverse_mass_matrix)
+    ColumnarCache(path, key=key).save(columns)
+
+
+def load_adaptation(path, key):
+    """
+    Returns the adaptation saved under `key` as `(init_params, step_size, inverse_mass_matrix)`,
+    or None if there is none or if it was saved for another model, configuration or data shape.
+    """
+    cache = ColumnarCache(path, key=key)
+    if not cache.is_valid():
+        return None
+    columns = {name: cache.load(name, mmap_mode=None) for name in cache.columns}
+    init_params = {name[2:]: np.asarray(value) for name, value in columns.items() if name.startswith('z_')}
+    return init_params, columns['step_size'], columns['inverse_mass_matrix']
+
+
+class WarmNUTS(NUTS):
+    """
+    NUTS started from a saved adaptation. The step size and diagonal inverse mass matrix
+    of the previous run, pooled over its chains, replace those of the initial state; the
+    mass matrix is kept fixed and the step size is only refined during the warmup, which
+    can therefore be short or skipped. With vectorized chains, every chain starts from the
+    same pooled step size and mass matrix.
+
+    :param model: numpyro model.
+    :param step_size: step size of every chain of the previous run.
+    :param inverse_mass_matrix: diagonal inverse mass matrix of every chain of the previous run.
+    :param kwargs: other parameters of :class:`numpyro.infer.NUTS`.
+    """
+
+    def __init__(self, model, step_size, inverse_mass_matrix, **kwargs):
+        step_size = float(onp.exp(onp.mean(onp.log(step_size))))
+        inverse_mass_matrix = onp.asarray(inverse_mass_matrix)
+        inverse_mass_matrix = inverse_mass_matrix.reshape(-1, inverse_mass_matrix.shape[-1]).mean(axis=0)
+        super(WarmNUTS, self).__init__(model, step_size=step_size, adapt_mass_matrix=False, **kwargs)
+        self._inverse_mass_matrix = np.asarray(inverse_mass_matrix)
+
+    def init(self, rng_key, num_warmup, init_params=None, model_args=(), model_kwargs={}):
+        state = super(WarmNUTS, self).init(rng_key, num_warmup, init_params, model_args, model_kwargs)
+        # The step size adaptation is centred on the saved step size rather than ten times it,
+        # as NUTS does from scratch, so that a short warmup does not wander off from it.
+        ss_init, _ = dual_averaging()
+        step_size, inverse_mass_matrix = np.asarray(self._step_size), self._inverse_mass_matrix
+        if np.ndim(rng_key) == 2:
+            # Vectorized chains: every field of the state has a leading chain axis.
+            num_chains = np.shape(rng_key)[0]
+            step_size = np.full((num_chains,), step_size)
+            inverse_mass_matrix = np.broadcast_to(inverse_mass_matrix, (num_chains,) + np.shape(inverse_mass_matrix))
+            ss_state = vmap(ss_init)(np.log(step_size))
+        else:
+            ss_state = ss_init(np.log(step_size))
+        adapt_state = state.adapt_state._replace(step_size=step_size,
+                                                 inverse_mass_matrix=inverse_mass_matrix,
+                                                 mass_matrix_sqrt=np.sqrt(np.reciprocal(inverse_mass_matrix)),
+                                                 ss_state=ss_state)
+        return state._replace(adapt_state=adapt_state)
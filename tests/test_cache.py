@@ -0,0 +1,93 @@
+import os
+import numpy as np
+import pandas as pd
+from modules.cache import ColumnarCache, Memo, dump_frame, load_frame, source_key
+
+
+def touch(path, mtime):
+    os.utime(path, (mtime, mtime))
+
+
+def test_columnar_cache_round_trip(tmp_path):
+    cache = ColumnarCache(str(tmp_path / "cache"), key=[1, 2])
+    columns = {"a": np.arange(12, dtype=np.float32).reshape(3, 4), "b": np.array([1, 2, 3], dtype=np.uint8)}
+    cache.save(columns, attrs={"n": 3})
+    cache = ColumnarCache(str(tmp_path / "cache"), key=[1, 2])
+    assert cache.is_valid()
+    assert cache.columns == ["a", "b"] and cache.attrs == {"n": 3}
+    for name, value in columns.items():
+        loaded = cache.load(name)
+        assert isinstance(loaded, np.memmap) and loaded.dtype == value.dtype
+        np.testing.assert_array_equal(loaded, value)
+
+
+def test_columnar_cache_is_stale_when_the_source_changes(tmp_path):
+    source = tmp_path / "calendar.csv"
+    source.write_text("d,wday\nd_1,1\n")
+    touch(str(source), 1000000000)
+    ColumnarCache(str(tmp_path / "cache"), key=source_key(str(source))).save({"a": np.zeros(2)})
+    assert ColumnarCache(str(tmp_path / "cache"), key=source_key(str(source))).is_valid()
+    touch(str(source), 1000000100)
+    assert not ColumnarCache(str(tmp_path / "cache"), key=source_key(str(source))).is_valid()
+    source.write_text("d,wday\nd_1,1\nd_2,2\n")
+    touch(str(source), 1000000000)
+    assert not ColumnarCache(str(tmp_path / "cache"), key=source_key(str(source))).is_valid()
+
+
+def test_columnar_cache_interrupted_write_is_invalid(tmp_path):
+    cache = ColumnarCache(str(tmp_path / "cache"), key="k")
+    cache.save({"a": np.zeros(2)})
+    cache.begin()
+    cache.write("a", np.ones(2))
+    assert not ColumnarCache(str(tmp_path / "cache"), key="k").is_valid()
+    cache.commit()
+    assert ColumnarCache(str(tmp_path / "cache"), key="k").is_valid()
+    cache.invalidate()
+    assert not os.path.exists(str(tmp_path / "cache"))
+
+
+def test_frame_round_trip(tmp_path):
+    df = pd.DataFrame({"item_id": ["a", "b", "a"],
+                       "store": pd.Categorical(["CA_1", "TX_1", "CA_1"]),
+                       "date": pd.to_datetime(["2011-01-29", "2011-01-30", "2011-01-31"]),
+                       "d_1": [0, 1, 2], "d_2": [3, 4, 5]},
+                      index=pd.Index([10, 11, 12], name="row"))
+    cache = ColumnarCache(str(tmp_path / "cache"), key="k")
+    dump_frame(cache, df, block=["d_1", "d_2"])
+    pd.testing.assert_frame_equal(load_frame(ColumnarCache(str(tmp_path / "cache"), key="k")), df,
+                                  check_categorical=False)
+
+
+def test_memo_reloads_a_rebuilt_cache(tmp_path):
+    memo = Memo()
+    source = tmp_path / "sales.csv"
+    source.write_text("id,d_1\na,1\n")
+    touch(str(source), 1000000000)
+
+    def get(value):
+        cache = ColumnarCache(str(tmp_path / "cache"), key=source_key(str(source)))
+        if not cache.is_valid():
+            cache.save({"a": np.full(2, value)})
+        return memo.get(cache, "a", lambda: cache.load("a", mmap_mode=None))
+
+    np.testing.assert_array_equal(get(1.), [1., 1.])
+    np.testing.assert_array_equal(get(2.), [1., 1.])
+    assert memo.stats == {"loads": 1, "hits": 1, "entries": 1}
+    touch(str(source), 1000000100)
+    np.testing.assert_array_equal(get(2.), [2., 2.])
+    assert memo.loads == 2
+
+
+def test_memo_invalidate_by_path(tmp_path):
+    memo = Memo()
+    caches = [ColumnarCache(str(tmp_path / name), key="k") for name in ("a", "b")]
+    for cache in caches:
+        memo.get(cache, "x", lambda: 0)
+    memo.invalidate(str(tmp_path / "a"))
+    assert memo.stats["entries"] == 1
+    memo.get(caches[1], "x", lambda: 0)
+    memo.get(caches[0], "x", lambda: 0)
+    assert (memo.loads, memo.hits) == (3, 1)
+    memo.enabled = False
+    memo.get(caches[1], "x", lambda: 0)
+    assert memo.loads == 4
@@ -0,0 +1,87 @@
+import os
+import numpy as onp
+import pytest
+import jax.numpy as np
+from jax import random
+import numpyro
+import numpyro.distributions as dist
+from numpyro.infer import MCMC, NUTS
+from modules.checkpoint import Checkpoint, code_modules, run_key, run_mcmc
+from modules.numpyro_models import HierarchicalLLM
+
+
+class Interrupted(Exception):
+    pass
+
+
+def regression(x, y=None):
+    beta = numpyro.sample('beta', dist.Normal(0., 1.))
+    sigma = numpyro.sample('sigma', dist.HalfNormal(1.))
+    numpyro.sample('obs', dist.Normal(beta * x, sigma), obs=y)
+
+
+def regression_inputs():
+    x = np.asarray(onp.random.RandomState(0).randn(50), dtype=np.float32)
+    return {'x': x, 'y': 2. * x + 0.1}
+
+
+def test_states_and_chunks(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path), key='k')
+    assert checkpoint.load_state(lambda: None) is None
+    template = lambda: {'a': np.zeros(2), 'b': (np.zeros(()), np.zeros(3))}  # noqa: E731
+    for n in (0, 10):
+        checkpoint.save_state({'a': np.full(2, n), 'b': (np.array(n), np.arange(3) + n)}, n)
+        checkpoint.save_chunk(n, {'x': onp.full((2, 5), n)})
+    state, n = checkpoint.load_state(template)
+    assert n == 10
+    onp.testing.assert_array_equal(state['b'][1], [10, 11, 12])
+    assert sorted(name for name in os.listdir(str(tmp_path)) if name.startswith('state')) == ['state-00000010']
+    onp.testing.assert_array_equal(checkpoint.load_chunks(20, axis=1)['x'], onp.repeat([[0] * 5 + [10] * 5], 2, 0))
+    assert len(list(checkpoint.iter_chunks(10))) == 1
+    # Checkpoints of another run are ignored.
+    assert Checkpoint(str(tmp_path), key='other').load_state(template) is None
+    checkpoint.clear()
+    assert not os.path.exists(str(tmp_path))
+
+
+def test_run_key():
+    inputs = regression_inputs()
+    key = run_key(regression, inputs, num_samples=10)
+    assert key == run_key(regression, dict(inputs), num_samples=10)
+    assert key != run_key(regression, inputs, num_samples=20)
+    assert key != run_key(regression, dict(inputs, y=inputs['y'] + 1), num_samples=10)
+    model = HierarchicalLLM({'snap': 1})
+    assert run_key(model.model, inputs) != run_key(HierarchicalLLM({'snap': 2}).model, inputs)
+    # The key covers the code the model runs, not only the model method.
+    names = {module.__name__ for module in code_modules(model.model)}
+    assert {'modules.numpyro_models', 'modules.kalman', 'modules.scan', 'modules.covariates'} <= names
+
+
+def test_run_mcmc_resumes_an_interrupted_run(tmp_path, monkeypatch):
+    inputs = regression_inputs()
+
+    def sample(path):
+        mcmc = MCMC(NUTS(regression), num_warmup=50, num_samples=60, progress_bar=False)
+        return run_mcmc(mcmc, random.PRNGKey(0), inputs, Checkpoint(path, run_key(regression, inputs)), 20)[0]
+
+    expected = sample(str(tmp_path / 'uninterrupted'))
+    assert expected['beta'].shape == (1, 60)
+    save_chunk = Checkpoint.save_chunk
+
+    def interrupted(self, start, values):
+        if start >= 20:
+            raise Interrupted()
+        save_chunk(self, start, values)
+
+    monkeypatch.setattr(Checkpoint, 'save_chunk', interrupted)
+    with pytest.raises(Interrupted):
+        sample(str(tmp_path / 'interrupted'))
+    monkeypatch.setattr(Checkpoint, 'save_chunk', save_chunk)
+    assert 'state-00000020' in os.listdir(str(tmp_path / 'interrupted'))
+    # The run resumes from its last checkpoint, without a new warmup.
+    warmups = []
+    monkeypatch.setattr(MCMC, 'warmup', lambda self, *args, **kwargs: warmups.append(1))
+    samples = sample(str(tmp_path / 'interrupted'))
+    assert not warmups
+    for name in expected:
+        onp.testing.assert_allclose(samples[name], expected[name], rtol=1e-5)
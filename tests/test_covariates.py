@@ -0,0 +1,54 @@
+import numpy as onp
+from jax import jit
+from modules.covariates import FactoredCovariates, covariate_effect, take_items
+
+
+def covariates(l=30, n_common=4, n_individual=2, n_items=5, seed=0):
+    rng = onp.random.RandomState(seed)
+    return FactoredCovariates(common=rng.rand(l, n_common).astype(onp.float32),
+                              individual=rng.rand(l, n_individual, n_items).astype(onp.float32))
+
+
+def dense_effect(X, beta):
+    # Baseline: the effect of the dense `T x n_cov x n_items` tensor, item by item.
+    X = onp.asarray(X, dtype=onp.float64)
+    return onp.stack([X[:, :, i] @ onp.asarray(beta, dtype=onp.float64)[:, i] for i in range(X.shape[-1])], axis=1)
+
+
+def test_effect_matches_the_dense_matmul():
+    X = covariates()
+    beta = onp.random.RandomState(1).randn(X.shape[1], X.shape[2]).astype(onp.float32)
+    assert onp.asarray(X).shape == X.shape == (30, 6, 5)
+    expected = dense_effect(X, beta)
+    onp.testing.assert_allclose(X.effect(beta), expected, rtol=1e-5, atol=1e-5)
+    onp.testing.assert_allclose(covariate_effect(X, beta), expected, rtol=1e-5, atol=1e-5)
+    onp.testing.assert_allclose(covariate_effect(X.dense(), beta), expected, rtol=1e-5, atol=1e-5)
+
+
+def test_slices_and_items():
+    X = covariates()
+    beta = onp.random.RandomState(1).randn(X.shape[1], X.shape[2]).astype(onp.float32)
+    items = onp.array([0, 3])
+    onp.testing.assert_allclose(X[:10].effect(beta), dense_effect(X, beta)[:10], rtol=1e-5, atol=1e-5)
+    onp.testing.assert_allclose(take_items(X, items).effect(beta[:, items]), dense_effect(X, beta)[:, items],
+                                rtol=1e-5, atol=1e-5)
+    onp.testing.assert_array_equal(take_items(X.dense(), items), onp.asarray(X)[..., items])
+
+
+def test_effect_under_jit():
+    X = covariates()
+    beta = onp.random.RandomState(1).randn(X.shape[1], X.shape[2]).astype(onp.float32)
+    onp.testing.assert_allclose(jit(covariate_effect)(X, beta), dense_effect(X, beta), rtol=1e-5, atol=1e-5)
+
+
+def test_categorical_gather_matches_the_one_hot_matmul():
+    dims = (7, 12)
+    rng = onp.random.RandomState(2)
+    X = covariates()
+    codes = onp.stack([rng.randint(0, dim, size=30) for dim in dims], axis=1)
+    X = FactoredCovariates(X.common, X.individual, codes, categorical_dims=dims)
+    assert X.shape == (30, 6 + sum(dims), 5)
+    beta = rng.randn(X.shape[1], X.shape[2]).astype(onp.float32)
+    expected = dense_effect(X, beta)
+    onp.testing.assert_allclose(X.effect(beta), expected, rtol=1e-5, atol=1e-5)
+    onp.testing.assert_allclose(X[5:].effect(beta), expected[5:], rtol=1e-5, atol=1e-5)
@@ -0,0 +1,70 @@
+import numpy as onp
+import pytest
+import jax.numpy as np
+from jax import jacfwd, random
+from modules.kalman import kalman_filter, simulate, simulation_smoother
+from modules.numpyro_models import HierarchicalLLM
+
+T, N = 12, 3
+
+
+def llm_deviation(rw, alpha, scan_method):
+    # Z - mu of HierarchicalLLM given the level innovations `rw`, with a zero covariate effect.
+    mu = np.zeros((T, N))
+    _, Z = HierarchicalLLM({'snap': 1}, scan_method=scan_method).scan_fn(
+        alpha=alpha, mu_0=mu[0], llm_0=rw[0], rw_0=np.zeros(N), llm=rw, mu=mu, dz=np.arange(1, T))
+    return np.concatenate([mu[:1], Z], axis=0)
+
+
+def parameters():
+    rng = onp.random.RandomState(0)
+    alpha = np.asarray(rng.uniform(-0.8, 0.8, size=N), dtype=np.float32)
+    sigma_trend = np.asarray(rng.uniform(0.02, 0.1, size=N), dtype=np.float32)
+    sigma_sto = np.asarray(rng.uniform(0.1, 0.3, size=N), dtype=np.float32)
+    y = np.asarray(rng.randn(T, N) * 0.3, dtype=np.float32)
+    return y, alpha, sigma_trend, sigma_sto
+
+
+def gaussian_log_likelihood(y, A, sigma_trend, sigma_sto):
+    # Log density of y = A e + eps, e ~ N(0, sigma_trend^2 I), eps ~ N(0, sigma_sto^2 I).
+    cov = sigma_trend ** 2 * A @ A.T + sigma_sto ** 2 * onp.eye(len(y))
+    _, logdet = onp.linalg.slogdet(cov)
+    return -0.5 * (len(y) * onp.log(2 * onp.pi) + logdet + y @ onp.linalg.solve(cov, y))
+
+
+@pytest.mark.parametrize('scan_method', ['associative', 'sequential'])
+@pytest.mark.parametrize('masked', [False, True])
+def test_kalman_log_likelihood_matches_the_llm_scan(scan_method, masked):
+    y, alpha, sigma_trend, sigma_sto = parameters()
+    brk = onp.array([0, 4, 9]) if masked else onp.zeros(N, dtype=int)
+    mask = onp.arange(T)[:, None] >= brk
+    log_lik, _ = kalman_filter(y, alpha, sigma_trend, sigma_sto, mask=np.asarray(mask))
+    # The deviation is linear in the innovations: its Jacobian gives the covariance of y.
+    jacobian = onp.asarray(jacfwd(lambda rw: llm_deviation(rw, alpha, scan_method))(np.zeros((T, N))), onp.float64)
+    for i in range(N):
+        A = jacobian[:, i, :, i][brk[i]:]
+        expected = gaussian_log_likelihood(onp.asarray(y, onp.float64)[brk[i]:, i], A,
+                                           float(sigma_trend[i]), float(sigma_sto[i]))
+        onp.testing.assert_allclose(float(log_lik[:, i].sum()), expected, rtol=1e-4)
+        assert onp.all(onp.asarray(log_lik)[:brk[i], i] == 0)
+
+
+def test_simulate_matches_the_llm_scan():
+    _, alpha, sigma_trend, _ = parameters()
+    rw = np.asarray(onp.random.RandomState(1).randn(T, N), dtype=np.float32) * sigma_trend
+    x_0 = np.stack([np.zeros(N), np.zeros(N), rw[0]], axis=-1)
+    onp.testing.assert_allclose(simulate(alpha, x_0, rw[1:])[..., 0], llm_deviation(rw, alpha, 'sequential'),
+                                rtol=1e-5, atol=1e-6)
+
+
+def test_simulation_smoother_is_consistent_with_the_observations():
+    y, alpha, sigma_trend, sigma_sto = parameters()
+    sigma_sto = sigma_sto * 1e-3
+    states = simulation_smoother(random.PRNGKey(0), y, alpha, sigma_trend, sigma_sto)
+    assert states.shape == (T, N, 3)
+    # With almost no observation noise the smoothed deviation follows the observations,
+    # from the second day on: the deviation of the first day is zero.
+    onp.testing.assert_allclose(states[0, :, 0], 0.)
+    onp.testing.assert_allclose(states[1:, :, 0], y[1:], atol=1e-2)
+    # The states follow the transition of the trend: R[t] = R[t - 1] + L[t].
+    onp.testing.assert_allclose(states[1:, :, 1], states[:-1, :, 1] + states[1:, :, 2], atol=1e-5)
@@ -0,0 +1,80 @@
+import numpy as onp
+import pytest
+from modules.checkpoint import Checkpoint
+from modules.optimisation import Plateau, run_steps
+
+
+class Interrupted(Exception):
+    pass
+
+
+def test_plateau_reduces_the_step_size_then_stops():
+    plateau = Plateau(step_size=0.1, window=10, rtol=1e-3, smoothing=0., factor=0.5, max_reductions=2)
+    # A decreasing loss does not stop the run.
+    assert not plateau(onp.linspace(100., 50., 20))
+    assert plateau.step_size == 0.1
+    # Every window of a flat loss is a plateau: the first two halve the step size.
+    assert not plateau(onp.full(11, 50.))
+    assert (plateau.step_size, plateau.reductions) == (0.05, 1)
+    assert not plateau(onp.full(11, 50.))
+    assert plateau.step_size == 0.025
+    assert plateau(onp.full(11, 50.))
+
+
+def test_plateau_waits_for_a_window_after_a_reduction():
+    plateau = Plateau(window=10, smoothing=0., max_reductions=1)
+    assert not plateau(onp.full(11, 1.))
+    assert plateau.reductions == 1
+    assert not plateau(onp.full(10, 1.))
+    assert plateau(onp.full(1, 1.))
+
+
+def test_plateau_stops_on_a_non_finite_loss():
+    assert Plateau()(onp.array([1., onp.nan]))
+
+
+def steps(calls):
+    # A deterministic optimisation whose losses depend on the state, run by chunks.
+    def step_fn(state, start, size):
+        calls.append(start)
+        losses = state + onp.arange(size)
+        return state + size, losses.astype(onp.float64)
+
+    return step_fn
+
+
+def test_run_steps_with_early_stopping(tmp_path):
+    calls = []
+    _, losses = run_steps(lambda state, start, size: (state, onp.ones(size)), 0, 1000, 100,
+                              stop=Plateau(window=50), loss_file=str(tmp_path / 'loss.csv'))
+    # A flat loss halves the step size after the first two chunks and stops the run after the third.
+    assert len(losses) == 300
+    saved = onp.loadtxt(str(tmp_path / 'loss.csv'), delimiter=',', skiprows=1)
+    onp.testing.assert_array_equal(saved[:, 0], onp.arange(300))
+    state, losses = run_steps(steps(calls), 0, 250, 100)
+    assert (state, calls) == (250, [0, 100, 200])
+    onp.testing.assert_array_equal(losses, onp.arange(250))
+
+
+def test_run_steps_resumes_from_a_checkpoint(tmp_path):
+    expected = run_steps(steps([]), 0, 500, 100)
+    checkpoint = Checkpoint(str(tmp_path / 'run'), key='k')
+    step_fn = steps([])
+
+    def interrupted(state, start, size):
+        if start == 300:
+            raise Interrupted()
+        return step_fn(state, start, size)
+
+    with pytest.raises(Interrupted):
+        run_steps(interrupted, 0, 500, 100, checkpoint=checkpoint)
+    calls = []
+    stop = Plateau(window=1000)
+    state, losses = run_steps(steps(calls), 0, 500, 100, checkpoint=checkpoint, stop=stop,
+                              loss_file=str(tmp_path / 'loss.csv'))
+    assert calls == [300, 400]
+    assert state == expected[0]
+    onp.testing.assert_array_equal(losses, expected[1])
+    # The stopping rule and the loss file see the losses from before the interruption.
+    assert len(stop.smoothed) == 500
+    assert onp.loadtxt(str(tmp_path / 'loss.csv'), delimiter=',', skiprows=1).shape == (500, 2)
@@ -0,0 +1,50 @@
+import numpy as onp
+import pytest
+from jax import jit
+from modules.scan import affine_scan, prefix_sum
+
+
+def loop(a, b, z_init):
+    # Reference: the recursion z[t] = a[t] * z[t - 1] + b[t] step by step, in float64.
+    a = onp.broadcast_to(a, b.shape) if onp.ndim(a) < onp.ndim(b) else a
+    z, out = z_init, []
+    for t in range(b.shape[0]):
+        z = a[t] * z + b[t]
+        out.append(z)
+    return onp.stack(out)
+
+
+@pytest.mark.parametrize('method', ['associative', 'sequential'])
+@pytest.mark.parametrize('l', [1, 2, 7, 64, 100])
+@pytest.mark.parametrize('constant', [False, True])
+@pytest.mark.parametrize('with_init', [False, True])
+def test_affine_scan_matches_a_loop(method, l, constant, with_init):
+    rng = onp.random.RandomState(l)
+    b = rng.randn(l, 3)
+    a = rng.uniform(-0.95, 0.95, size=(3,) if constant else (l, 3))
+    z_init = rng.randn(3) if with_init else None
+    expected = loop(a, b, onp.zeros(3) if z_init is None else z_init)
+    out = affine_scan(a.astype(onp.float32), b.astype(onp.float32),
+                      None if z_init is None else z_init.astype(onp.float32), method=method)
+    assert out.shape == b.shape
+    onp.testing.assert_allclose(out, expected, rtol=1e-4, atol=1e-4)
+
+
+def test_affine_scan_under_jit():
+    rng = onp.random.RandomState(0)
+    a, b, z_init = rng.uniform(-0.9, 0.9, size=3), rng.randn(50, 3), rng.randn(3)
+    out = jit(affine_scan)(a.astype(onp.float32), b.astype(onp.float32), z_init.astype(onp.float32))
+    onp.testing.assert_allclose(out, loop(a, b, z_init), rtol=1e-4, atol=1e-4)
+
+
+def test_affine_scan_unknown_method():
+    with pytest.raises(ValueError):
+        affine_scan(onp.ones(2, dtype=onp.float32), onp.ones((3, 2), dtype=onp.float32), method='parallel')
+
+
+@pytest.mark.parametrize('method', ['associative', 'sequential'])
+@pytest.mark.parametrize('l', [1, 5, 64, 129])
+def test_prefix_sum_matches_a_loop(method, l):
+    x = onp.random.RandomState(l).randn(l, 2, 3)
+    expected = loop(onp.ones(()), x, onp.zeros((2, 3)))
+    onp.testing.assert_allclose(prefix_sum(x.astype(onp.float32), method=method), expected, rtol=1e-4, atol=1e-4)
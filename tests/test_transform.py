@@ -0,0 +1,70 @@
+import numpy as onp
+import pytest
+from modules.transform import cluster_aggregate, convolve, expectation_convolution, hump, indicator, segment_sum
+
+
+def reference(x, kernel):
+    # Baseline: one `numpy.convolve` per column.
+    columns = x.reshape(x.shape[0], -1)
+    out = onp.stack([onp.convolve(columns[:, i], kernel, mode='same') for i in range(columns.shape[1])], axis=1)
+    return out.reshape(out.shape[:1] + x.shape[1:])
+
+
+@pytest.mark.parametrize('method', ['auto', 'direct', 'fft'])
+@pytest.mark.parametrize('shape', [(50,), (50, 7), (50, 3, 4)])
+@pytest.mark.parametrize('k', [1, 4, 9, 60])
+def test_convolve_matches_numpy(method, shape, k):
+    rng = onp.random.RandomState(k)
+    x, kernel = rng.randn(*shape), rng.randn(k)
+    out = convolve(x, kernel, method=method, block_size=2)
+    assert out.shape == reference(x, kernel).shape
+    onp.testing.assert_allclose(out, reference(x, kernel), rtol=1e-9, atol=1e-9)
+
+
+@pytest.mark.parametrize('method', ['direct', 'fft'])
+def test_convolve_integers(method):
+    rng = onp.random.RandomState(0)
+    x, kernel = rng.randint(0, 5, size=(40, 6)), onp.square(onp.arange(-5, 6))
+    out = convolve(x, kernel, method=method)
+    assert onp.issubdtype(out.dtype, onp.integer)
+    onp.testing.assert_array_equal(out, reference(x, kernel))
+
+
+def test_transforms_match_the_baseline():
+    x = onp.random.RandomState(0).randint(0, 2, size=(100, 3)).astype(onp.uint8)
+    signal = onp.append(onp.arange(2), -onp.arange(2)[::-1])
+    onp.testing.assert_allclose(expectation_convolution(x, 2, True), reference(x.astype(onp.int64), signal))
+    onp.testing.assert_allclose(expectation_convolution(x[:, 0], 2, False),
+                                reference(x[:, :1].astype(onp.int64), onp.arange(2)))
+    signal = onp.square(onp.concatenate([onp.arange(0, 15), onp.arange(0, 14)[::-1]]))
+    expected = reference(x.astype(onp.int64), signal)
+    onp.testing.assert_allclose(hump(x, 15), expected / expected.max(), rtol=1e-6)
+
+
+def baseline_aggregate(y, X, clusters):
+    # Baseline: sums and market-share weighted averages computed cluster by cluster.
+    y_ = onp.stack([y[:, c].sum(axis=-1) for c in clusters], axis=-1)
+    weights = [y[:, c].sum(axis=0) / y[:, c].sum() for c in clusters]
+    X_ = onp.stack([onp.average(X[..., c], axis=-1, weights=w) for c, w in zip(clusters, weights)], axis=-1)
+    return y_, X_
+
+
+def test_cluster_aggregate_matches_the_baseline():
+    rng = onp.random.RandomState(0)
+    y = rng.poisson(3, size=(60, 9)).astype(onp.float32)
+    X = rng.rand(60, 2, 9).astype(onp.float32)
+    labels = onp.array([2, 0, 1, 0, 2, 2, 1, 0, 1])
+    clusters = [onp.flatnonzero(labels == i) for i in range(3)]
+    y_, shares, X_ = cluster_aggregate(y, X, labels)
+    expected_y, expected_X = baseline_aggregate(y.astype(onp.float64), X.astype(onp.float64), clusters)
+    assert y_.shape == (60, 3) and X_.shape == (60, 2, 3) and X_.dtype == onp.float32
+    onp.testing.assert_allclose(y_, expected_y, rtol=1e-6)
+    onp.testing.assert_allclose(X_, expected_X, rtol=1e-5)
+    onp.testing.assert_allclose(segment_sum(shares, indicator(labels)), onp.ones(3))
+
+
+def test_cluster_aggregate_keeps_integer_sales():
+    y = onp.array([[1, 2, 3], [4, 5, 6]], dtype=onp.int32)
+    y_, _, _ = cluster_aggregate(y, onp.ones((2, 1, 3)), onp.array([0, 1, 0]))
+    assert onp.issubdtype(y_.dtype, onp.integer)
+    onp.testing.assert_array_equal(y_, [[4, 2], [10, 5]])